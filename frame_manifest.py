@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+from typing import Dict, List, Union
+
+Sources = Union[str, List[str]]
+
+
+def file_signature(path: str, use_hash: bool = False) -> Dict:
+    """文件签名：大小 + mtime（可选内容sha1）"""
+    st = os.stat(path)
+    signature = {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    if use_hash:
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha1.update(block)
+        signature["sha1"] = sha1.hexdigest()
+    return signature
+
+
+@contextmanager
+def atomic_output(dst_path: str):
+    """产出临时路径，写入成功后原子替换为dst_path；失败时删除临时文件
+
+    临时文件与目标在同一目录并保留扩展名，便于PIL/ffmpeg按扩展名推断格式。
+    """
+    base, ext = os.path.splitext(dst_path)
+    tmp_path = f"{base}.tmp{os.getpid()}{ext}"
+    try:
+        yield tmp_path
+        os.replace(tmp_path, dst_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class FrameManifest:
+    """记录在输出旁的处理清单（JSON），用于增量、可中断恢复的帧预处理
+
+    每条记录以输出路径为键，保存来源文件（一个或多个）的签名、处理参数和输出签名。
+    来源、参数或输出任一变化（包括输出缺失或被改动）都视为需要重新处理。
+    """
+
+    def __init__(
+        self,
+        manifest_path: str,
+        params: Dict,
+        use_hash: bool = False,
+        autosave_every: int = 100,
+    ):
+        self.manifest_path = manifest_path
+        self.params = params
+        self.use_hash = use_hash
+        self.autosave_every = autosave_every
+        self.entries = {}
+        self._unsaved = 0
+
+        if os.path.exists(manifest_path):
+            try:
+                with open(manifest_path, "r", encoding="utf-8") as f:
+                    self.entries = json.load(f).get("entries", {})
+            except (OSError, ValueError) as e:
+                print(f"提示：清单文件无法读取，将全部重新处理：{manifest_path}（{e}）")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.save()
+
+    @staticmethod
+    def _key(path: str) -> str:
+        return os.path.abspath(path)
+
+    def _sources_signature(self, sources: Sources):
+        if isinstance(sources, str):
+            return [self._key(sources), file_signature(sources, self.use_hash)]
+        return [
+            [self._key(src), file_signature(src, self.use_hash)] for src in sources
+        ]
+
+    def is_fresh(self, sources: Sources, output_path: str) -> bool:
+        """输出是否已由相同来源与参数生成且未被改动"""
+        entry = self.entries.get(self._key(output_path))
+        if entry is None or entry.get("params") != self.params:
+            return False
+        if not os.path.exists(output_path):
+            return False
+        try:
+            return (
+                entry.get("output") == file_signature(output_path)
+                and entry.get("sources") == self._sources_signature(sources)
+            )
+        except OSError:
+            return False
+
+    def record(self, sources: Sources, output_path: str):
+        """记录一次成功的输出"""
+        self.entries[self._key(output_path)] = {
+            "sources": self._sources_signature(sources),
+            "params": self.params,
+            "output": file_signature(output_path),
+        }
+        self._unsaved += 1
+        if self._unsaved >= self.autosave_every:
+            self.save()
+
+    def save(self):
+        """原子写入清单文件"""
+        if self._unsaved == 0 and os.path.exists(self.manifest_path):
+            return
+        manifest_dir = os.path.dirname(os.path.abspath(self.manifest_path))
+        os.makedirs(manifest_dir, exist_ok=True)
+        with atomic_output(self.manifest_path) as tmp_path:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"entries": self.entries}, f, ensure_ascii=False)
+        self._unsaved = 0
@@ -1,6 +1,7 @@
 import json
 import math
 import os
+import sys
 from io import BytesIO
 
 import markdown
@@ -13,6 +14,13 @@ from qwen_vl_utils import process_vision_info
 from transformers import AutoProcessor
 from vllm import LLM, SamplingParams
 
+# 与服务端共用 sam2/utils 下的预处理缓存；追加到搜索路径末尾，
+# 避免服务端的utils/config等顶层包遮蔽transformers、vllm等依赖中的同名模块
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "sam2"))
+from utils.frame_planner import plan_frames
+from utils.keyframes import FrameSignatureCache
+from utils.mm_cache import FrameArrayCache, VisionInputCache
+
 os.environ["TRANSFORMERS_OFFLINE"] = "1"
 os.environ["HF_DATASETS_OFFLINE"] = "1"
 os.environ["HF_ENDPOINT"] = "https://hf-mirror.com"
@@ -22,6 +30,20 @@ os.environ["VLLM_WORKER_MULTIPROC_METHOD"] = "spawn"
 model_path = os.environ.get("MODEL_PATH")
 processor = None
 llm = None
+vision_cache = VisionInputCache(
+    int(os.environ.get("vision_input_cache_bytes", 1024**3))
+)
+# frame_cache_dir 与服务端配置相同时共享磁盘上的帧数组缓存
+frame_cache = FrameArrayCache(
+    int(os.environ.get("frame_cache_bytes", 2 * 1024**3)),
+    disk_dir=os.environ.get("frame_cache_dir"),
+    workers=int(os.environ.get("frame_decode_workers", 8)),
+)
+# 帧签名缓存（写入帧目录下的.frame_signatures.npz，与服务端共用）
+signature_cache = FrameSignatureCache(
+    int(os.environ.get("frame_decode_workers", 8)),
+    int(os.environ.get("signature_cache_bytes", 256 * 1024**2)),
+)
 
 
 def initialize_models():
@@ -33,10 +55,12 @@ def initialize_models():
     processor = AutoProcessor.from_pretrained(model_path)
     max_model_len = int(os.environ.get("max_model_len", 32768))
     llm_seed = int(os.environ.get("llm_seed", 42))
+    enable_prefix_caching = os.environ.get("enable_prefix_caching", "1") == "1"
     llm = LLM(
         model=model_path,
         max_model_len=max_model_len,
         seed=llm_seed,
+        enable_prefix_caching=enable_prefix_caching,
     )
 
     print("模型初始化完成")
@@ -56,11 +80,18 @@ def prepare_inputs_for_vllm(messages, processor):
         messages, tokenize=False, add_generation_prompt=True
     )
 
-    image_inputs, video_inputs, video_kwargs = process_vision_info(
+    # 同一批帧的预处理结果被缓存，追问时跳过解码与缩放
+    patch_size = processor.image_processor.patch_size
+    patch_factor = patch_size * getattr(processor.image_processor, "merge_size", 2)
+    image_inputs, video_inputs, video_kwargs = vision_cache.get_or_process(
         messages,
-        image_patch_size=processor.image_processor.patch_size,
-        return_video_kwargs=True,
-        return_video_metadata=True,
+        lambda msgs: process_vision_info(
+            frame_cache.materialize(msgs, patch_factor),
+            image_patch_size=patch_size,
+            return_video_kwargs=True,
+            return_video_metadata=True,
+        ),
+        patch_size,
     )
 
     mm_data = {}
@@ -219,8 +250,27 @@ def generate_all_grids(results, messages, output_dir=".", grid_size=16, columns=
     return grid_images
 
 
-def generate_image_content(folder_path, orig_fps, target_fps, total_frames):
-    """从视频帧文件夹中按目标帧率采样图像并生成带时间戳的消息列表"""
+def get_patch_factor():
+    """合并后视觉token对应的像素边长；模型未初始化时取环境变量vision_patch_size（默认16）"""
+    if processor is None:
+        return int(os.environ.get("vision_patch_size", 16)) * 2
+    image_processor = processor.image_processor
+    return image_processor.patch_size * getattr(image_processor, "merge_size", 2)
+
+
+def generate_image_content(
+    folder_path,
+    orig_fps,
+    target_fps,
+    total_frames,
+    sampling="uniform",
+    patch_factor=None,
+):
+    """从视频帧文件夹中按目标帧率采样图像并生成带时间戳的消息列表
+
+    sampling为"motion"时把帧预算集中到画面变化剧烈的区间，静止片段只稀疏取帧。
+    patch_factor默认由get_patch_factor()决定，无需先初始化模型。
+    """
     folder_path = os.path.abspath(folder_path)
 
     jpg_files = [f for f in os.listdir(folder_path) if f.lower().endswith(".jpg")]
@@ -237,18 +287,38 @@ def generate_image_content(folder_path, orig_fps, target_fps, total_frames):
         )
         total_frames = total_available
 
-    if target_fps > orig_fps:
-        raise ValueError(f"目标帧率({target_fps})不能大于原始帧率({orig_fps})")
-
-    if total_frames == 1:
-        selected_indices = [0]
-    else:
-        step = (total_available - 1) // (total_frames - 1)
-        selected_indices = [i * step for i in range(total_frames)]
-        selected_indices = [min(idx, total_available - 1) for idx in selected_indices]
+    # 在上下文预算内选择帧数与分辨率：先降分辨率，仍放不下时减少帧数（仍覆盖整段视频）
+    max_model_len = int(os.environ.get("max_model_len", 32768))
+    max_new_tokens = int(os.environ.get("max_new_tokens", 4096))
+    prompt_token_reserve = int(os.environ.get("prompt_token_reserve", 512))
+    if patch_factor is None:
+        patch_factor = get_patch_factor()
+    with Image.open(os.path.join(folder_path, jpg_files[0])) as img:
+        source_size = img.size
+
+    scores = None
+    if sampling == "motion":
+        scores = signature_cache.change_scores(folder_path, jpg_files)
+
+    plan = plan_frames(
+        total_available,
+        orig_fps,
+        target_fps,
+        total_frames,
+        max_model_len - max_new_tokens - prompt_token_reserve,
+        patch_factor,
+        source_size,
+        max_side=int(os.environ.get("frame_plan_max_side", 640)),
+        min_side=int(os.environ.get("frame_plan_min_side", 256)),
+        change_scores=scores,
+    )
+    print(
+        f"帧规划: {len(plan['indices'])}帧, {plan['width']}x{plan['height']}, "
+        f"约{plan['visual_tokens']}个视觉token(预算{plan['token_budget']})"
+    )
 
-    image_path = [os.path.join(folder_path, jpg_files[i]) for i in selected_indices]
-    seconds = [i / orig_fps for i in selected_indices]
+    image_path = [os.path.join(folder_path, jpg_files[i]) for i in plan["indices"]]
+    seconds = plan["seconds"]
 
     message = []
     for sec, img_path in zip(seconds, image_path):
@@ -257,8 +327,8 @@ def generate_image_content(folder_path, orig_fps, target_fps, total_frames):
             {
                 "type": "image",
                 "image": f"file://{img_path}",
-                "resized_width": 640,
-                "resized_height": 360,
+                "resized_width": plan["width"],
+                "resized_height": plan["height"],
             }
         )
 
@@ -266,11 +336,17 @@ def generate_image_content(folder_path, orig_fps, target_fps, total_frames):
 
 
 def get_messages_with_images(
-    video_dir: str, user_prompt: str, original_fps=12.5, target_fps=2, frames_needed=100
+    video_dir: str,
+    user_prompt: str,
+    original_fps=12.5,
+    target_fps=2,
+    frames_needed=100,
+    sampling="uniform",
+    patch_factor=None,
 ):
     """构建包含视频帧和用户提示的完整消息"""
     images_content = generate_image_content(
-        video_dir, original_fps, target_fps, frames_needed
+        video_dir, original_fps, target_fps, frames_needed, sampling, patch_factor
     )
     messages = [
         {
@@ -319,6 +395,7 @@ def main():
     original_fps = 12.5
     target_fps = 2
     frames_needed = 60
+    sampling = os.environ.get("sampling", "uniform")
     output_dir = "."
     grid_size = 16
     columns = 4
@@ -332,7 +409,7 @@ def main():
     )
 
     image_messages = get_messages_with_images(
-        video_dir, user_prompt, original_fps, target_fps, frames_needed
+        video_dir, user_prompt, original_fps, target_fps, frames_needed, sampling
     )
     print("构建的消息结构:")
     print(json.dumps(image_messages, ensure_ascii=False, indent=2))
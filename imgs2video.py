@@ -1,9 +1,128 @@
-
 import numpy as np
 import os
 import subprocess
 import glob
 import argparse
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from frame_manifest import FrameManifest, atomic_output
+
+# 各编码器的默认preset/crf；SVT-AV1的preset为0-13（越大越快），libaom对应-cpu-used（0-8）
+CODEC_DEFAULTS = {
+    "libx264": {"preset": "medium", "crf": 23},
+    "libsvtav1": {"preset": "8", "crf": 35},
+    "libaom-av1": {"preset": "6", "crf": 35},
+}
+
+
+def encoder_args(codec: str = "libx264", preset: str = None, crf: int = None):
+    """生成ffmpeg编码参数（-c:v / -preset / -crf）"""
+    if codec not in CODEC_DEFAULTS:
+        raise ValueError(f"不支持的编码器: {codec}，可选: {', '.join(CODEC_DEFAULTS)}")
+    defaults = CODEC_DEFAULTS[codec]
+    preset = str(preset if preset is not None else defaults["preset"])
+    crf = crf if crf is not None else defaults["crf"]
+
+    args = ["-c:v", codec]
+    if codec == "libaom-av1":
+        # libaom没有-preset，速度档位用-cpu-used；恒定质量模式需要-b:v 0
+        args += ["-cpu-used", preset, "-crf", str(crf), "-b:v", "0"]
+    else:
+        args += ["-preset", preset, "-crf", str(crf)]
+    return args + ["-pix_fmt", "yuv420p"]
+
+
+def _frame_label_filter(total: int) -> str:
+    return f"drawtext=text='Frame %{{frame_num}}/{total}':x=w-tw-10:y=h-th-10:fontcolor=yellow:fontsize=24:box=1:boxcolor=black"
+
+
+def _load_rgb_frame(path: str, width: int, height: int) -> bytes:
+    """解码并缩放单帧，返回rgb24原始字节"""
+    with Image.open(path) as img:
+        if img.format == "JPEG":
+            img.draft("RGB", (width, height))
+        img = img.convert("RGB")
+        if img.size != (width, height):
+            img = img.resize((width, height), Image.Resampling.BILINEAR)
+        return img.tobytes()
+
+
+def _encode_concat(sampled_files, output_path, fps, target_width, target_height, codec_args):
+    """concat demuxer模式：ffmpeg逐个打开图片，文件列表写入唯一的临时文件"""
+    fd, list_path = tempfile.mkstemp(prefix="imgs2video_", suffix=".txt")
+    try:
+        with os.fdopen(fd, "w") as f:
+            for file_path in sampled_files:
+                f.write(f"file '{os.path.abspath(file_path)}'\n")
+                f.write(f"duration {1/fps}\n")
+
+        ffmpeg_cmd = [
+            "ffmpeg", "-y",
+            "-f", "concat",
+            "-safe", "0",
+            "-i", list_path,
+            "-vf", f"scale={target_width}:{target_height},{_frame_label_filter(len(sampled_files))}",
+            *codec_args,
+            "-r", str(fps),
+        ]
+
+        # 先编码到临时文件，成功后原子替换，避免中断留下不完整的视频
+        with atomic_output(output_path) as tmp_path:
+            subprocess.run(ffmpeg_cmd + [tmp_path], check=True)
+    finally:
+        # 清理临时文件
+        if os.path.exists(list_path):
+            os.remove(list_path)
+
+
+def _encode_stream(sampled_files, output_path, fps, target_width, target_height, codec_args,
+                   workers: int = 4):
+    """流式模式：线程池解码/缩放，按顺序把rgb24原始帧写入单个ffmpeg进程的stdin"""
+    ffmpeg_cmd = [
+        "ffmpeg", "-y",
+        "-f", "rawvideo",
+        "-pix_fmt", "rgb24",
+        "-s", f"{target_width}x{target_height}",
+        "-r", str(fps),
+        "-i", "-",
+        "-vf", _frame_label_filter(len(sampled_files)),
+        *codec_args,
+    ]
+
+    with atomic_output(output_path) as tmp_path, tempfile.TemporaryFile() as stderr_file:
+        proc = subprocess.Popen(ffmpeg_cmd + [tmp_path], stdin=subprocess.PIPE, stderr=stderr_file)
+        broken_pipe = False
+        try:
+            # 在途帧数有上限（workers*2），内存占用不随帧数增长
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                pending = deque()
+                files = iter(sampled_files)
+                for file_path in files:
+                    pending.append(pool.submit(_load_rgb_frame, file_path, target_width, target_height))
+                    if len(pending) >= workers * 2:
+                        break
+                while pending:
+                    proc.stdin.write(pending.popleft().result())
+                    next_file = next(files, None)
+                    if next_file is not None:
+                        pending.append(pool.submit(_load_rgb_frame, next_file, target_width, target_height))
+        except BrokenPipeError:
+            # ffmpeg提前退出，以其退出码和stderr报错
+            broken_pipe = True
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                broken_pipe = True
+            returncode = proc.wait()
+        if returncode != 0 or broken_pipe:
+            stderr_file.seek(0)
+            stderr = stderr_file.read().decode(errors="replace")[-4096:]
+            raise subprocess.CalledProcessError(returncode, ffmpeg_cmd, stderr=stderr)
 
 
 def images_to_av1_video_direct(
@@ -12,28 +131,42 @@ def images_to_av1_video_direct(
     fps: float = 5,
     max_duration: float = 30,
     target_width: int = 640,
-    target_height: int = 360
+    target_height: int = 360,
+    force: bool = False,
+    codec: str = "libx264",
+    preset: str = None,
+    crf: int = None,
+    mode: str = "concat",
+    workers: int = 4
 ):
     """
     直接使用ffmpeg从图片创建视频（更高效的方法）
+
+    mode="concat"使用concat demuxer（列表写入唯一临时文件）；mode="stream"在线程池中解码缩放，
+    通过stdin把原始RGB帧送入单个ffmpeg进程。codec可选libx264（默认）、libsvtav1、libaom-av1。
+
+    视频旁的清单记录采样帧及参数；二者均未变化且视频完好时跳过重新编码（force=True强制编码）。
     """
-    
+    if mode not in ("concat", "stream"):
+        raise ValueError(f"不支持的模式: {mode}")
+    codec_args = encoder_args(codec, preset, crf)
+
     if not os.path.exists(image_dir):
         raise ValueError(f"图片目录不存在: {image_dir}")
- 
+
     image_pattern = os.path.join(image_dir, "*.jpg")
     image_files = glob.glob(image_pattern)
-    
+
     if not image_files:
         raise ValueError(f"在目录 {image_dir} 中未找到jpg图片")
-    
+
     image_files.sort()
-    
+
     print(f"找到 {len(image_files)} 张图片")
-    
+
     max_frames = int(max_duration * fps)
     total_images = len(image_files)
-    
+
     if total_images <= max_frames:
         sampled_files = image_files
         print(f"图片数量较少，使用所有 {total_images} 张图片")
@@ -41,37 +174,31 @@ def images_to_av1_video_direct(
         sampled_indices = np.linspace(0, total_images - 1, max_frames, dtype=int)
         sampled_files = [image_files[i] for i in sampled_indices]
         print(f"从 {total_images} 张图片中均匀采样 {max_frames} 张")
-    
-    # 创建文件列表供ffmpeg使用
-    with open("input_files.txt", "w") as f:
-        for file_path in sampled_files:
-            f.write(f"file '{file_path}'\n")
-            f.write(f"duration {1/fps}\n")
-    
+
+    manifest = FrameManifest(
+        os.path.splitext(output_path)[0] + ".manifest.json",
+        params={"fps": fps, "max_duration": max_duration,
+                "width": target_width, "height": target_height, "codec_args": codec_args},
+    )
+    if not force and manifest.is_fresh(sampled_files, output_path):
+        print(f"采样帧与参数均未变化，跳过：{output_path}")
+        return
+
     try:
-        # 使用ffmpeg直接处理
-        ffmpeg_cmd = [
-            "ffmpeg", "-y",
-            "-f", "concat",
-            "-safe", "0",
-            "-i", "input_files.txt",
-            "-vf", f"scale={target_width}:{target_height},drawtext=text='Frame %{{frame_num}}/{len(sampled_files)}':x=w-tw-10:y=h-th-10:fontcolor=yellow:fontsize=24:box=1:boxcolor=black",
-            "-c:v", "libx264",
-            "-pix_fmt", "yuv420p",
-            "-r", str(fps),
-            output_path
-        ]
-        
-        subprocess.run(ffmpeg_cmd, check=True)
+        if mode == "stream":
+            _encode_stream(sampled_files, output_path, fps, target_width, target_height,
+                           codec_args, workers=workers)
+        else:
+            _encode_concat(sampled_files, output_path, fps, target_width, target_height, codec_args)
+        with manifest:
+            manifest.record(sampled_files, output_path)
         print(f"✅ 视频已保存: {output_path}")
-        
+
     except subprocess.CalledProcessError as e:
         print(f"❌ ffmpeg处理失败: {e}")
+        if e.stderr:
+            print(e.stderr)
         raise
-    finally:
-        # 清理临时文件
-        if os.path.exists("input_files.txt"):
-            os.remove("input_files.txt")
 
 
 if __name__ == '__main__':
@@ -79,13 +206,21 @@ if __name__ == '__main__':
     argparser.add_argument("--image-dir", type=str, required=True)
     argparser.add_argument("--fps", type=str, default=5)
     argparser.add_argument("--max-duration", type=str, default=30)
+    argparser.add_argument("--force", action="store_true", help="忽略清单，强制重新编码")
+    argparser.add_argument("--mode", choices=["concat", "stream"], default="concat",
+                           help="concat: ffmpeg逐个读取图片；stream: 线程池解码后经stdin送入ffmpeg")
+    argparser.add_argument("--codec", choices=list(CODEC_DEFAULTS), default="libx264",
+                           help="视频编码器（libsvtav1/libaom-av1输出AV1）")
+    argparser.add_argument("--preset", type=str, help="编码速度档位（默认按编码器取值）")
+    argparser.add_argument("--crf", type=int, help="恒定质量因子（越大越快、越小）")
+    argparser.add_argument("--workers", type=int, default=4, help="stream模式的解码线程数")
     args = argparser.parse_args()
-    
+
     image_dir = args.image_dir
     output_path = str(image_dir).strip("/") + ".mp4"
     fps = float(args.fps)
     max_duration = float(args.max_duration)
-    
+
     try:
         images_to_av1_video_direct(
             image_dir=image_dir,
@@ -93,9 +228,15 @@ if __name__ == '__main__':
             fps=fps,
             max_duration=max_duration,
             target_width=640,
-            target_height=360
+            target_height=360,
+            force=args.force,
+            codec=args.codec,
+            preset=args.preset,
+            crf=args.crf,
+            mode=args.mode,
+            workers=args.workers
         )
 
-        
+
     except Exception as e:
-        print(f"❌ 处理失败: {e}")
\ No newline at end of file
+        print(f"❌ 处理失败: {e}")
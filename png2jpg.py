@@ -1,79 +1,205 @@
 import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
 from PIL import Image
 
-def convert_png_to_jpg(input_dir, recursive=False, quality=100, background=(255, 255, 255)):
+from frame_manifest import FrameManifest, atomic_output
+
+_turbo_jpeg = None  # 每个进程懒加载一次的TurboJPEG实例
+
+
+def _get_turbo_jpeg():
+    """加载libjpeg-turbo编码器（PyTurboJPEG），不可用时返回None"""
+    global _turbo_jpeg
+    if _turbo_jpeg is None:
+        try:
+            from turbojpeg import TurboJPEG
+            _turbo_jpeg = TurboJPEG()
+        except Exception as e:
+            print(f"提示：turbojpeg不可用，改用Pillow编码：{e}")
+            _turbo_jpeg = False
+    return _turbo_jpeg or None
+
+
+def composite_alpha(img, background=(255, 255, 255)):
+    """将图片解码为RGB数组，透明区域按alpha与背景色混合（numpy整数运算）"""
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        rgba = np.asarray(img.convert('RGBA'), dtype=np.uint16)
+        alpha = rgba[..., 3:4]
+        bg = np.asarray(background, dtype=np.uint16)
+        rgb = (rgba[..., :3] * alpha + bg * (255 - alpha) + 127) // 255
+        return rgb.astype(np.uint8)
+    # 无透明通道，直接转换为RGB
+    return np.asarray(img.convert('RGB'))
+
+
+def convert_one(png_path, jpg_path, quality=100, background=(255, 255, 255),
+                optimize=True, encoder="pillow"):
     """
-    将指定目录下的PNG文件转换为JPG格式
-    :param input_dir: 目标文件夹路径
-    :param recursive: 是否递归处理子目录（True/False）
-    :param quality: JPG质量（1-100，100为最高）
-    :param background: PNG透明区域填充色（默认白色RGB(255,255,255)）
+    转换单个PNG（可在子进程中执行）
+    :return: (是否成功, 输入字节数, 输出字节数, 错误信息)
     """
-    # 遍历目录
+    try:
+        bytes_in = os.path.getsize(png_path)
+        with Image.open(png_path) as img:
+            rgb = composite_alpha(img, background)
+
+        # 写临时文件后原子替换
+        turbo = _get_turbo_jpeg() if encoder == "turbo" else None
+        with atomic_output(jpg_path) as tmp_path:
+            if turbo is not None:
+                from turbojpeg import TJPF_RGB
+                with open(tmp_path, 'wb') as f:
+                    f.write(turbo.encode(rgb, quality=quality, pixel_format=TJPF_RGB))
+            else:
+                Image.fromarray(rgb).save(tmp_path, 'JPEG', quality=quality, optimize=optimize)
+        return True, bytes_in, os.path.getsize(jpg_path), None
+    except Exception as e:
+        return False, 0, 0, str(e)
+
+
+def _iter_png_files(input_dir, recursive):
+    """按目录遍历顺序产出(png_path, jpg_path)"""
     for root, dirs, files in os.walk(input_dir):
         for file in files:
             # 筛选PNG文件（不区分大小写，如.png/.PNG）
             if file.lower().endswith('.png'):
-                png_path = os.path.join(root, file)
                 # 生成JPG文件名（替换后缀）
                 jpg_filename = os.path.splitext(file)[0] + '.jpg'
-                jpg_path = os.path.join(root, jpg_filename)
-                
-                # 避免重复转换（如果JPG已存在则跳过）
-                if os.path.exists(jpg_path):
-                    print(f"已存在，跳过：{jpg_path}")
-                    continue
-                
-                try:
-                    # 打开PNG图片
-                    with Image.open(png_path) as img:
-                        # 处理透明通道（PNG可能有alpha通道，JPG不支持）
-                        if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
-                            # 创建白色背景的新图片
-                            background_img = Image.new(img.mode[:-1], img.size, background)
-                            # 将PNG粘贴到背景上（保留非透明区域）
-                            background_img.paste(img, img.split()[-1])  # 使用alpha通道作为掩码
-                            img = background_img.convert('RGB')
-                        else:
-                            # 无透明通道，直接转换为RGB
-                            img = img.convert('RGB')
-                        
-                        # 保存为JPG（最高质量）
-                        img.save(jpg_path, 'JPEG', quality=quality, optimize=True)
-                        print(f"转换成功：{png_path} -> {jpg_path}")
-                except Exception as e:
-                    print(f"转换失败 {png_path}：{str(e)}")
-        
+                yield os.path.join(root, file), os.path.join(root, jpg_filename)
+
         # 如果不递归，只处理当前目录后退出
         if not recursive:
             break
 
+
+def convert_png_to_jpg(input_dir, recursive=False, quality=100, background=(255, 255, 255),
+                       force=False, use_hash=False, workers=1, optimize=True, encoder="pillow",
+                       max_in_flight=None):
+    """
+    将指定目录下的PNG文件转换为JPG格式
+    :param input_dir: 目标文件夹路径
+    :param recursive: 是否递归处理子目录（True/False）
+    :param quality: JPG质量（1-100，100为最高）
+    :param background: PNG透明区域填充色（默认白色RGB(255,255,255)）
+    :param force: 忽略清单，全部重新转换
+    :param use_hash: 清单中额外记录源文件sha1
+    :param workers: 并行进程数，1为串行
+    :param optimize: Pillow编码时是否启用optimize（更小但更慢）
+    :param encoder: "pillow" 或 "turbo"（libjpeg-turbo，不可用时回退Pillow）
+    :param max_in_flight: 同时提交的最大任务数（默认workers*2），限制内存占用
+    """
+    # 目标文件夹下的处理清单：PNG与参数（含编码器和optimize）未变且JPG完好时跳过
+    # turbojpeg不可用时实际使用Pillow编码，清单中记录实际使用的编码器
+    if encoder == "turbo" and _get_turbo_jpeg() is None:
+        encoder = "pillow"
+    manifest = FrameManifest(
+        os.path.join(input_dir, ".png2jpg_manifest.json"),
+        params={
+            "quality": quality,
+            "background": list(background),
+            "encoder": encoder,
+            "optimize": optimize,
+        },
+        use_hash=use_hash,
+    )
+    stats = {"converted": 0, "failed": 0, "skipped": 0, "bytes_in": 0, "bytes_out": 0}
+
+    def pending_jobs():
+        for png_path, jpg_path in _iter_png_files(input_dir, recursive):
+            # 避免重复转换（清单记录的JPG仍与当前PNG、参数一致才跳过）
+            if not force and manifest.is_fresh(png_path, jpg_path):
+                print(f"已是最新，跳过：{jpg_path}")
+                stats["skipped"] += 1
+                continue
+            yield png_path, jpg_path
+
+    def handle(png_path, jpg_path, result):
+        ok, bytes_in, bytes_out, error = result
+        if ok:
+            manifest.record(png_path, jpg_path)
+            stats["converted"] += 1
+            stats["bytes_in"] += bytes_in
+            stats["bytes_out"] += bytes_out
+            print(f"转换成功：{png_path} -> {jpg_path}")
+        else:
+            stats["failed"] += 1
+            print(f"转换失败 {png_path}：{error}")
+
+    options = (quality, background, optimize, encoder)
+    start_time = time.perf_counter()
+    with manifest:
+        if workers <= 1:
+            for png_path, jpg_path in pending_jobs():
+                handle(png_path, jpg_path, convert_one(png_path, jpg_path, *options))
+        else:
+            # 边遍历边提交，在途任务数有上限，避免大目录一次性排满队列
+            max_in_flight = max_in_flight or workers * 2
+            in_flight = {}
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                for png_path, jpg_path in pending_jobs():
+                    if len(in_flight) >= max_in_flight:
+                        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            handle(*in_flight.pop(future), future.result())
+                    future = pool.submit(convert_one, png_path, jpg_path, *options)
+                    in_flight[future] = (png_path, jpg_path)
+                for future in list(in_flight):
+                    handle(*in_flight.pop(future), future.result())
+
+    elapsed = time.perf_counter() - start_time
+    files_per_sec = stats["converted"] / elapsed if elapsed > 0 else 0.0
+    ratio = stats["bytes_out"] / stats["bytes_in"] if stats["bytes_in"] else 0.0
+    print(f"统计：转换{stats['converted']}个，失败{stats['failed']}个，跳过{stats['skipped']}个，"
+          f"耗时{elapsed:.2f}s（{files_per_sec:.1f} 文件/秒），"
+          f"输入{stats['bytes_in'] / 1024 ** 2:.1f}MB -> 输出{stats['bytes_out'] / 1024 ** 2:.1f}MB（{ratio:.2f}x）")
+    return stats
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(description="批量将PNG转换为高质量JPG")
     parser.add_argument("--dir", default=".", help="目标文件夹（默认当前目录）")
     parser.add_argument("--recursive", action="store_true", help="是否递归处理子目录")
     parser.add_argument("--quality", type=int, default=100, help="JPG质量（1-100，默认100）")
-    parser.add_argument("--bg", type=int, nargs=3, default=[255,255,255], 
+    parser.add_argument("--bg", type=int, nargs=3, default=[255,255,255],
                         help="透明区域填充色（RGB值，默认白色 255 255 255）")
+    parser.add_argument("--force", action="store_true", help="忽略清单，全部重新转换")
+    parser.add_argument("--hash", action="store_true", help="清单中额外记录源文件sha1")
+    parser.add_argument("--workers", type=int, default=1, help="并行进程数（默认1，串行）")
+    parser.add_argument("--max-in-flight", type=int, help="同时在途的最大任务数（默认workers*2）")
+    parser.add_argument("--no-optimize", action="store_true", help="关闭Pillow的optimize（更快，文件略大）")
+    parser.add_argument("--encoder", choices=["pillow", "turbo"], default="pillow",
+                        help="JPEG编码器：pillow 或 turbo（需安装PyTurboJPEG）")
     args = parser.parse_args()
-    
+
     # 验证质量参数
     if not (1 <= args.quality <= 100):
         print("错误：质量参数必须在1-100之间")
         exit(1)
-    
+
     # 验证背景色参数
     for c in args.bg:
         if not (0 <= c <= 255):
             print("错误：背景色RGB值必须在0-255之间")
             exit(1)
-    
+
+    if args.workers <= 0:
+        print("错误：--workers必须为正整数")
+        exit(1)
+
     # 执行转换
     convert_png_to_jpg(
         input_dir=args.dir,
         recursive=args.recursive,
         quality=args.quality,
-        background=tuple(args.bg)
+        background=tuple(args.bg),
+        force=args.force,
+        use_hash=args.hash,
+        workers=args.workers,
+        optimize=not args.no_optimize,
+        encoder=args.encoder,
+        max_in_flight=args.max_in_flight
     )
-    print("转换完成")
\ No newline at end of file
+    print("转换完成")
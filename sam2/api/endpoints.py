@@ -1,15 +1,22 @@
+import json
 import logging
+import mimetypes
 import os
+from email.utils import formatdate, parsedate_to_datetime
 
 from config.settings import settings
-from fastapi import FastAPI, HTTPException, Query
-from fastapi.responses import FileResponse
-from models.schemas import (ScanFolderRequest, SegmentBatchRequest,
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from models.schemas import (IngestVideoRequest, PropagateRequest,
+                            ScanFolderRequest, SegmentBatchRequest,
                             SegmentRequest, VideoAnalysisRequest,
                             VideoAnalysisResponse, VisionAnalysisRequest,
                             VisionAnalysisResponse)
-from services.file_service import scan_folder_for_frames
-from worker.task_worker import enqueue_task, get_task_status
+from services.file_service import get_frame_thumbnail, scan_folder_for_frames
+from services.vision_service import vision_service
+from utils.frame_planner import TokenBudgetExceeded
+from worker.task_worker import (enqueue_task, get_store_stats,
+                                get_task_status, stream_task_events)
 
 
 class RouteFilter(logging.Filter):
@@ -24,6 +31,63 @@ class RouteFilter(logging.Filter):
 for handler in logging.getLogger("uvicorn.access").handlers:
     handler.addFilter(RouteFilter())
 
+VALID_IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".tiff", ".tif")
+
+
+def _resolve_frame_path(folder_path: str, filename: str) -> str:
+    """校验并返回帧图像的完整路径"""
+    if not os.path.isabs(folder_path):
+        raise HTTPException(
+            status_code=400, detail="不支持相对路径，只能用绝对路径"
+        )
+
+    file_path = os.path.join(folder_path, filename)
+    if not os.path.exists(file_path):
+        raise HTTPException(status_code=404, detail=f"图像文件不存在: {file_path}")
+
+    if not file_path.lower().endswith(VALID_IMAGE_EXTENSIONS):
+        raise HTTPException(status_code=400, detail="不支持的文件格式")
+
+    return file_path
+
+
+def _estimate_visual_tokens(estimate) -> int:
+    """入队前估计视觉token数：超出上下文预算返回413，帧来源无效返回400"""
+    try:
+        return estimate()
+    except TokenBudgetExceeded as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except (ValueError, OSError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def _conditional_file_response(
+    request: Request, source_path: str, file_path: str, media_type: str, variant: str = ""
+):
+    """按源文件mtime/大小生成ETag与Last-Modified，客户端缓存仍有效时返回304"""
+    st = os.stat(source_path)
+    etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}{variant}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(st.st_mtime, usegmt=True),
+        "Cache-Control": "no-cache",
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        if etag in tags or "*" in tags:
+            return Response(status_code=304, headers=headers)
+    elif request.headers.get("if-modified-since"):
+        try:
+            since = parsedate_to_datetime(request.headers["if-modified-since"])
+            if int(st.st_mtime) <= since.timestamp():
+                return Response(status_code=304, headers=headers)
+        except (TypeError, ValueError):
+            pass
+
+    return FileResponse(file_path, media_type=media_type, headers=headers)
+
 
 def setup_routes(app: FastAPI):
     """设置API路由"""
@@ -33,32 +97,44 @@ def setup_routes(app: FastAPI):
         """扫描文件夹中的帧图像"""
         try:
             frames = scan_folder_for_frames(req.folder_path)
+            end = None if req.limit is None else req.offset + req.limit
             return {
                 "success": True,
                 "folder_path": req.folder_path,
                 "frame_count": len(frames),
-                "frames": frames,
+                "offset": req.offset,
+                "limit": req.limit,
+                "frames": frames[req.offset : end],
             }
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"扫描文件夹失败: {str(e)}")
 
     @app.get("/frame_image")
-    def get_frame_image(folder_path: str = Query(...), filename: str = Query(...)):
+    def get_frame_image(
+        request: Request, folder_path: str = Query(...), filename: str = Query(...)
+    ):
         """返回指定帧图像内容"""
-        if not os.path.isabs(folder_path):
-            raise HTTPException(
-                status_code=400, detail="不支持相对路径，只能用绝对路径"
-            )
-
-        file_path = os.path.join(folder_path, filename)
-        if not os.path.exists(file_path):
-            raise HTTPException(status_code=404, detail=f"图像文件不存在: {file_path}")
-
-        valid_extensions = (".jpg", ".jpeg", ".png", ".bmp", ".tiff", ".tif")
-        if not file_path.lower().endswith(valid_extensions):
-            raise HTTPException(status_code=400, detail="不支持的文件格式")
-
-        return FileResponse(file_path, media_type="image/jpeg")
+        file_path = _resolve_frame_path(folder_path, filename)
+        media_type = mimetypes.guess_type(file_path)[0] or "application/octet-stream"
+        return _conditional_file_response(request, file_path, file_path, media_type)
+
+    @app.get("/frame_thumb")
+    def get_frame_thumb(
+        request: Request,
+        folder_path: str = Query(...),
+        filename: str = Query(...),
+        max_side: int = Query(320, ge=16, le=4096),
+        quality: int = Query(80, ge=1, le=95),
+    ):
+        """返回帧的JPEG缩略图（磁盘缓存，按源文件mtime失效）"""
+        file_path = _resolve_frame_path(folder_path, filename)
+        try:
+            thumb_path = get_frame_thumbnail(file_path, max_side, quality)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"生成缩略图失败: {str(e)}")
+        return _conditional_file_response(
+            request, file_path, thumb_path, "image/jpeg", variant=f"-{max_side}-{quality}"
+        )
 
     @app.post("/segment_frame")
     def segment_frame_api(req: SegmentRequest):
@@ -70,21 +146,80 @@ def setup_routes(app: FastAPI):
         """提交多帧分割任务"""
         return enqueue_task(req)
 
+    @app.post("/propagate")
+    def propagate_api(req: PropagateRequest):
+        """提交关键帧掩码传播任务"""
+        return enqueue_task(req)
+
+    @app.post("/ingest_video")
+    def ingest_video_api(req: IngestVideoRequest):
+        """提交视频抽帧入库任务"""
+        return enqueue_task(req)
+
     @app.post("/analyze_video", response_model=VideoAnalysisResponse)
     def analyze_video_api(req: VideoAnalysisRequest):
         """提交视频分析任务"""
+        tokens = _estimate_visual_tokens(
+            lambda: vision_service.plan_video_request(req, estimate_only=True)[
+                "total_visual_tokens"
+            ]
+        )
         result = enqueue_task(req)
-        return VideoAnalysisResponse(task_id=result["task_id"], status=result["status"])
+        return VideoAnalysisResponse(
+            task_id=result["task_id"],
+            status=result["status"],
+            estimated_visual_tokens=tokens,
+        )
 
     @app.post("/analyze_image", response_model=VisionAnalysisResponse)
     def analyze_image_api(req: VisionAnalysisRequest):
         """提交视频分析任务"""
+        tokens = _estimate_visual_tokens(
+            lambda: vision_service.estimate_image_request_tokens(req)
+        )
         result = enqueue_task(req)
         return VisionAnalysisResponse(
-            task_id=result["task_id"], status=result["status"]
+            task_id=result["task_id"],
+            status=result["status"],
+            estimated_visual_tokens=tokens,
         )
 
     @app.get("/task_status/{task_id}")
     def task_status_api(task_id: str):
         """查询任务状态"""
         return get_task_status(task_id)
+
+    @app.get("/task_store_stats")
+    def task_store_stats_api():
+        """任务结果存储的大小与淘汰统计"""
+        return get_store_stats()
+
+    @app.get("/task_events/{task_id}")
+    async def task_events_api(task_id: str):
+        """以SSE推送任务状态：queued/processing/frame/progress/done/error"""
+        events = stream_task_events(task_id)
+        # 预取首个事件，使未知task_id在响应开始前返回404
+        first_event = await events.__anext__()
+
+        async def event_source():
+            event = first_event
+            try:
+                while True:
+                    if event is None:
+                        yield ": keep-alive\n\n"
+                    else:
+                        data = json.dumps(event, ensure_ascii=False)
+                        yield f"event: {event['event']}\ndata: {data}\n\n"
+                    try:
+                        event = await events.__anext__()
+                    except StopAsyncIteration:
+                        break
+            finally:
+                # 客户端断开时及时注销订阅
+                await events.aclose()
+
+        return StreamingResponse(
+            event_source(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
@@ -1,4 +1,5 @@
 from pathlib import Path
+from typing import Optional
 
 import torch
 from pydantic import BaseModel
@@ -20,6 +21,28 @@ class Settings(BaseModel):
     # VLLM 初始化参数
     tensor_parallel_size: int = 4
     mm_encoder_tp_mode: str = "weights"
+    # 自动前缀缓存：同一批帧上的不同提问复用图像token的KV缓存
+    enable_prefix_caching: bool = True
+    # process_vision_info 预处理结果缓存的字节预算
+    vision_input_cache_bytes: int = 1 * 1024**3
+    # 缩放后帧数组缓存：内存字节预算、可选的磁盘(.npy内存映射)目录、未命中帧的解码线程数
+    # 磁盘目录与 images_infer.py 的 frame_cache_dir 相同时两者共享缓存
+    frame_cache_bytes: int = 2 * 1024**3
+    frame_cache_dir: Optional[str] = None
+    frame_decode_workers: int = 8
+    # 按画面变化选帧时帧签名的内存缓存字节预算（按目录LRU淘汰，磁盘上的.npz不受影响）
+    signature_cache_bytes: int = 256 * 1024**2
+
+    # SAM2 批量分割参数
+    sam2_batch_size: int = 8
+    sam2_decode_workers: int = 4
+    # SAM2 图像特征缓存：设备上的字节预算；淘汰时溢出到CPU内存的预算（0表示不溢出）
+    sam2_embedding_cache_bytes: int = 2 * 1024**3
+    sam2_embedding_cache_cpu_bytes: int = 8 * 1024**3
+
+    # SAM2 视频传播参数
+    propagation_offload_video_to_cpu: bool = True
+    propagation_offload_state_to_cpu: bool = False
 
     # Qwen-VL 推理参数
     max_model_len: int = 16384
@@ -31,9 +54,45 @@ class Settings(BaseModel):
     presence_penalty: float = 1.5
     max_new_tokens: int = 2048
 
+    # 帧规划：上下文中为提示词与对话模板预留的token数，视觉patch边长（处理器未加载时使用），
+    # 单帧缩放后长边的上下限（预算不足时先降分辨率，再减少帧数）
+    prompt_token_reserve: int = 512
+    vision_patch_size: int = 16
+    frame_plan_max_side: int = 640
+    frame_plan_min_side: int = 256
+    # 图像分析请求（base64图像）送入模型的缩放尺寸，token估计与消息构建共用
+    vision_image_width: int = 640
+    vision_image_height: int = 360
+
+    # 长视频分析：每个推理窗口的帧数（超出上下文预算时自动缩小）与相邻窗口的重叠帧数
+    video_window_frames: int = 32
+    video_window_overlap: int = 4
+
+    # Qwen-VL 微批处理配置
+    llm_batch_size: int = 8
+    llm_batch_wait_ms: int = 50
+
     # 队列配置
     max_queue_wait_time: int = 30
-    task_queue_maxsize: int = 5
+
+    # 按模型划分的任务池：各自的队列长度和worker数
+    segmentation_queue_maxsize: int = 16
+    segmentation_workers: int = 2
+    vision_queue_maxsize: int = 16
+    vision_workers: int = 1
+    propagation_queue_maxsize: int = 4
+    propagation_workers: int = 1
+    ingest_queue_maxsize: int = 8
+    ingest_workers: int = 2
+
+    # 帧缩略图磁盘缓存目录与总大小上限
+    thumbnail_cache_dir: str = "../cache/frame_thumbs"
+    thumbnail_cache_max_bytes: int = 1 * 1024**3
+
+    # 任务结果存储：内存字节预算、完成后保留时长（秒）、超预算时溢出的SQLite路径
+    task_result_max_bytes: int = 512 * 1024**2
+    task_result_ttl: int = 3600
+    task_result_spill_path: Optional[str] = None
 
     class Config:
         env_file = ".env"
@@ -1,6 +1,11 @@
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Literal, Optional
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, model_validator
+
+
+# 分割结果格式：overlay为叠加后的base64 JPEG；rle为每个目标的COCO RLE；
+# png为单张调色板PNG标签图
+MaskOutputFormat = Literal["overlay", "rle", "png"]
 
 
 class SegmentRequest(BaseModel):
@@ -10,6 +15,7 @@ class SegmentRequest(BaseModel):
     obj_ids: List[int]
     bboxes: List[List[float]]
     conf_threshold: float = 0.0
+    output_format: MaskOutputFormat = "overlay"
 
 
 class SegmentBatchRequest(BaseModel):
@@ -19,20 +25,92 @@ class SegmentBatchRequest(BaseModel):
     obj_ids_list: List[List[int]]
     bboxes_list: List[List[List[float]]]
     conf_threshold: float = 0.0
+    output_format: MaskOutputFormat = "overlay"
+
+    @model_validator(mode="after")
+    def check_lengths(self):
+        """frame_indices、obj_ids_list、bboxes_list逐帧一一对应，每帧的目标ID与框数量相同"""
+        if not len(self.frame_indices) == len(self.obj_ids_list) == len(self.bboxes_list):
+            raise ValueError(
+                f"frame_indices({len(self.frame_indices)})、obj_ids_list({len(self.obj_ids_list)})"
+                f"与bboxes_list({len(self.bboxes_list)})长度必须相同"
+            )
+        for frame_idx, obj_ids, bboxes in zip(
+            self.frame_indices, self.obj_ids_list, self.bboxes_list
+        ):
+            if len(obj_ids) != len(bboxes):
+                raise ValueError(
+                    f"帧{frame_idx}的obj_ids({len(obj_ids)})与bboxes({len(bboxes)})数量必须相同"
+                )
+        return self
+
+
+class PropagatePrompt(BaseModel):
+    frame_idx: int
+    obj_ids: List[int]
+    bboxes: List[List[float]]
+
+
+class PropagateRequest(BaseModel):
+    """关键帧框提示 + SAM2视频预测器掩码传播
+
+    video_path 为按 %05d.jpg 编号的帧目录，frame_idx 为帧在目录中的序号。
+    """
+
+    video_path: str
+    prompts: List[PropagatePrompt] = Field(..., min_length=1)
+    start_frame_idx: Optional[int] = None
+    max_frame_num_to_track: Optional[int] = None
+    reverse: bool = False
+    output_format: MaskOutputFormat = "overlay"
+
+
+class IngestVideoRequest(BaseModel):
+    """视频入库：按目标fps与分辨率抽帧为 %05d.jpg 帧目录
+
+    output_dir 缺省为视频同名的 *_mp4 目录；width/height 只给一个时按比例缩放。
+    """
+
+    video_path: str
+    output_dir: Optional[str] = None
+    fps: Optional[float] = Field(default=None, gt=0, le=60.0)
+    width: Optional[int] = Field(default=None, gt=0)
+    height: Optional[int] = Field(default=None, gt=0)
+    quality: int = Field(default=2, ge=2, le=31, description="JPEG质量（-q:v，越小越好）")
+    overwrite: bool = Field(
+        default=False, description="output_dir已有.jpg帧时替换它们；否则拒绝执行"
+    )
 
 
 class ScanFolderRequest(BaseModel):
     folder_path: str
+    offset: int = Field(default=0, ge=0)
+    limit: Optional[int] = Field(default=None, ge=0, description="为0时只返回帧总数")
 
 
 class VideoAnalysisRequest(BaseModel):
-    video_dir: str
+    video_dir: str = Field(
+        ..., description="帧目录（%05d.jpg）或视频文件；视频文件直接解码采样帧，帧率取自文件"
+    )
     user_prompt: str
     original_fps: float = Field(default=12.5, ge=1.0, le=60.0)
     target_fps: float = Field(default=2.0, ge=0.1, le=30.0)
-    frames_needed: int = Field(default=60, ge=1, le=200)
+    frames_needed: int = Field(default=60, ge=1, le=2000)
     grid_size: int = Field(default=16, ge=1, le=64)
     columns: int = Field(default=4, ge=1, le=8)
+    window_frames: Optional[int] = Field(
+        default=None,
+        ge=1,
+        le=200,
+        description="每个推理窗口的帧数，默认取配置；显式指定且超出上下文预算时拒绝请求",
+    )
+    window_overlap: Optional[int] = Field(
+        default=None, ge=0, description="相邻窗口重叠的帧数，默认取配置"
+    )
+    sampling: Literal["uniform", "motion"] = Field(
+        default="uniform",
+        description="uniform按目标帧率均匀取帧；motion把帧预算集中到画面变化剧烈的区间（仅帧目录）",
+    )
 
 
 class VideoAnalysisResponse(BaseModel):
@@ -40,6 +118,7 @@ class VideoAnalysisResponse(BaseModel):
     status: str
     grid_images: Optional[List[str]] = None
     results: Optional[List[dict]] = None
+    estimated_visual_tokens: Optional[int] = None
     error: Optional[str] = None
 
 
@@ -48,6 +127,10 @@ class VisionAnalysisRequest(BaseModel):
 
     base64_images: list[str] = Field(..., description="Base64编码的图像数据")
     user_prompt: str = Field(..., description="用户提示词")
+    stream: bool = Field(False, description="流式解码，检测结果经任务事件逐个推送")
+    stream_annotated: bool = Field(
+        False, description="流式推送时附带该检测对应帧的标注图像"
+    )
 
     class Config:
         json_schema_extra = {
@@ -66,6 +149,9 @@ class VisionAnalysisResponse(BaseModel):
     results: Optional[List[Dict[str, Any]]] = Field(None, description="分析结果列表")
     annotated_image: Optional[str] = Field(None, description="带标注的Base64图像")
     detection_count: Optional[int] = Field(None, description="检测到的物体数量")
+    estimated_visual_tokens: Optional[int] = Field(
+        None, description="入队时估计的视觉token数"
+    )
     error: Optional[str] = Field(None, description="错误信息")
 
     class Config:
@@ -21,6 +21,7 @@ class VideoAnalysisClient:
             "frames_needed": kwargs.get("frames_needed", 60),
             "grid_size": kwargs.get("grid_size", 16),
             "columns": kwargs.get("columns", 4),
+            "sampling": kwargs.get("sampling", "uniform"),
         }
 
         response = requests.post(f"{self.base_url}/analyze_video", json=request_data)
@@ -52,6 +53,46 @@ class VideoAnalysisClient:
 
         raise TimeoutError(f"任务轮询超时 ({timeout}秒)")
 
+    def stream_task_events(self, task_id, timeout=300):
+        """通过SSE订阅任务事件，逐个产生事件字典，任务结束后停止"""
+        with requests.get(
+            f"{self.base_url}/task_events/{task_id}",
+            stream=True,
+            timeout=timeout,
+            headers={"Accept": "text/event-stream"},
+        ) as response:
+            response.raise_for_status()
+
+            data_lines = []
+            for line in response.iter_lines(decode_unicode=True):
+                if line is None:
+                    continue
+                if line.startswith("data:"):
+                    data_lines.append(line[5:].strip())
+                elif line == "" and data_lines:
+                    event = json.loads("\n".join(data_lines))
+                    data_lines = []
+                    yield event
+                    if event["event"] in ("done", "error"):
+                        return
+
+    def wait_task_events(self, task_id, timeout=300):
+        """等待任务完成（基于SSE推送），返回最终任务信息"""
+        for event in self.stream_task_events(task_id, timeout=timeout):
+            status = event["event"]
+            if status == "done":
+                return event
+            elif status == "error":
+                raise Exception(f"任务处理失败: {event.get('result', 'Unknown error')}")
+            elif status == "frame":
+                print(f"已完成帧 {event['done']}/{event.get('total') or '?'}")
+            elif status == "detection":
+                print(f"收到检测结果: {event['detection']}")
+            else:
+                print(f"任务状态: {status}")
+
+        raise Exception("事件流意外结束")
+
     def save_base64_images(self, grid_images_base64, output_dir="output"):
         """将base64编码的图像保存到文件"""
         import os
@@ -82,8 +123,23 @@ class VideoAnalysisClient:
 
         final_result = self.poll_task_status(task_id)
 
-        analysis_result = final_result["result"]
+        return self.handle_analysis_result(final_result["result"], **kwargs)
+
+    def analyze_video_with_events(self, video_dir, user_prompt, **kwargs):
+        """完整的视频分析流程（提交任务 + SSE推送结果）"""
+        print("提交视频分析任务...")
+        submit_result = self.submit_analysis_task(video_dir, user_prompt, **kwargs)
+        task_id = submit_result["task_id"]
+
+        print(f"任务已提交，ID: {task_id}")
+        print("等待任务事件...")
+
+        final_result = self.wait_task_events(task_id)
+
+        return self.handle_analysis_result(final_result["result"], **kwargs)
 
+    def handle_analysis_result(self, analysis_result, **kwargs):
+        """打印并保存分析结果"""
         if analysis_result["status"] == "success":
             print(f"分析成功！共生成 {analysis_result['grid_count']} 个网格图像")
             print(f"检测到 {len(analysis_result['results'])} 个目标")
@@ -130,7 +186,7 @@ def main():
     }
 
     try:
-        result = client.analyze_video_with_polling(
+        result = client.analyze_video_with_events(
             video_dir, user_prompt, **analysis_params
         )
 
@@ -1,23 +1,25 @@
 import os
 from contextlib import asynccontextmanager
-from threading import Thread
 
 from api.endpoints import setup_routes
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from loguru import logger
+from services.file_service import schedule_thumbnail_prune
 from services.model_service import model_service
-from worker.task_worker import worker_loop
+from worker.task_worker import start_workers, stop_workers
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
 
     model_service._load_models()
-    Thread(target=worker_loop, daemon=True).start()
-    logger.info("SAM2 models loaded and worker started.")
+    start_workers()
+    schedule_thumbnail_prune()
+    logger.info("SAM2 models loaded and workers started.")
     yield
 
+    stop_workers()
     model_service.cleanup()
 
 
@@ -1,41 +1,290 @@
-import glob
+import hashlib
 import os
+import subprocess
+import tempfile
+import time
+from threading import Lock, Thread
+from typing import List, Optional
 
+import natsort
+from config.settings import settings
 from fastapi import HTTPException
 from loguru import logger
+from models.schemas import IngestVideoRequest
+from utils.image_utils import save_thumbnail
+from utils.video_utils import extract_frames_from_video
+
+
+class FolderIndex:
+    """帧目录索引缓存
+
+    按目录缓存 os.scandir 的结果（文件名与子目录），以目录mtime判断是否失效：
+    新增/删除文件只会改变其所在目录的mtime，因此只重新扫描变化的目录。
+    在目录树版本（各目录mtime）不变时，排序后的帧列表等派生视图直接复用。
+    mtime与扫描时间过近的目录（同一时间粒度内可能还有写入）下次仍会重新扫描。
+    """
+
+    # mtime距扫描时间小于该值时不信任缓存（兼容秒级mtime的文件系统）
+    RACY_WINDOW_NS = 2_000_000_000
+
+    def __init__(self):
+        self._dirs = {}
+        self._views = {}
+        self._lock = Lock()
+
+    def _scan_dir(self, path: str, mtime_ns: int) -> dict:
+        files, subdirs = [], []
+        with os.scandir(path) as it:
+            for entry in it:
+                # 与glob一致：忽略隐藏文件和目录
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir():
+                    subdirs.append(entry.name)
+                elif entry.is_file():
+                    files.append(entry.name)
+        return {
+            "mtime_ns": mtime_ns,
+            "scanned_ns": time.time_ns(),
+            "files": files,
+            "subdirs": subdirs,
+        }
+
+    def _get_dir(self, path: str) -> dict:
+        mtime_ns = os.stat(path).st_mtime_ns
+        cached = self._dirs.get(path)
+        if (
+            cached is None
+            or cached["mtime_ns"] != mtime_ns
+            or cached["scanned_ns"] - mtime_ns < self.RACY_WINDOW_NS
+        ):
+            cached = self._scan_dir(path, mtime_ns)
+            self._dirs[path] = cached
+        return cached
+
+    def _walk(self, root: str, recursive: bool):
+        """刷新并返回 (版本, [(目录, 文件名列表)])"""
+        version, listing = [], []
+        stack = [root]
+        while stack:
+            path = stack.pop()
+            try:
+                entry = self._get_dir(path)
+            except (FileNotFoundError, NotADirectoryError):
+                self._dirs.pop(path, None)
+                continue
+            version.append((path, entry["mtime_ns"], entry["scanned_ns"]))
+            listing.append((path, entry["files"]))
+            if recursive:
+                stack.extend(os.path.join(path, d) for d in reversed(entry["subdirs"]))
+        return tuple(version), listing
+
+    def _view(self, root: str, name: str, recursive: bool, build):
+        with self._lock:
+            version, listing = self._walk(root, recursive)
+            cached = self._views.get((root, name))
+            if cached is not None and cached[0] == version:
+                return cached[1]
+            result = build(listing)
+            self._views[(root, name)] = (version, result)
+            return result
+
+    def frames(self, folder_path: str) -> List[dict]:
+        """递归列出 .jpg/.jpeg 帧（按文件名排序），返回的列表为共享缓存，调用方不应修改"""
+
+        def build(listing):
+            frames = []
+            for path, files in listing:
+                for filename in files:
+                    if not filename.endswith((".jpg", ".jpeg")):
+                        continue
+                    file_path = os.path.join(path, filename)
+                    frames.append(
+                        {
+                            "index": None,
+                            "filename": filename,
+                            "file_path": file_path,
+                            "relative_path": os.path.relpath(file_path, folder_path),
+                        }
+                    )
+            frames.sort(key=lambda x: (x["filename"], x["relative_path"]))
+            for i, frame in enumerate(frames):
+                frame["index"] = i
+            return frames
+
+        return self._view(folder_path, "frames", True, build)
+
+    def jpg_files(self, folder_path: str) -> List[str]:
+        """当前目录下的 .jpg 文件名（不区分大小写，自然排序）"""
+
+        def build(listing):
+            _, files = listing[0] if listing else (None, [])
+            return natsort.natsorted(f for f in files if f.lower().endswith(".jpg"))
+
+        return self._view(folder_path, "jpg_files", False, build)
+
+    def invalidate(self, folder_path: Optional[str] = None):
+        """清除某目录（含子目录）或全部缓存"""
+        with self._lock:
+            if folder_path is None:
+                self._dirs.clear()
+                self._views.clear()
+                return
+            prefix = os.path.join(folder_path, "")
+            for path in [p for p in self._dirs if p == folder_path or p.startswith(prefix)]:
+                del self._dirs[path]
+            for key in [k for k in self._views if k[0] == folder_path]:
+                del self._views[key]
+
+
+folder_index = FolderIndex()
 
 
 def scan_folder_for_frames(folder_path: str):
-    """扫描文件夹中的帧图像"""
+    """扫描文件夹中的帧图像（使用目录索引缓存，返回的列表不应被修改）"""
     if not os.path.exists(folder_path):
         raise HTTPException(status_code=404, detail=f"文件夹不存在: {folder_path}")
 
-    image_extensions = ["*.jpg", "*.jpeg"]
-    frames = []
+    return folder_index.frames(folder_path)
+
+
+# 新写入的缩略图累计超过缓存预算的这一比例时，在后台线程检查一次磁盘缓存总大小
+THUMBNAIL_PRUNE_FRACTION = 0.05
+_thumbnail_bytes_written = 0
+_thumbnail_lock = Lock()
+_prune_thread: Optional[Thread] = None
+
+
+def _prune_thumbnail_cache(max_bytes: int):
+    """缩略图缓存超过max_bytes时，按写入时间从旧到新删除，直到降到预算的90%以下"""
+    entries = []
+    for root, _, files in os.walk(settings.thumbnail_cache_dir):
+        for name in files:
+            if name.endswith(".tmp"):
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_ctime, st.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    if total <= max_bytes:
+        return
+    entries.sort()
+    target = max_bytes * 0.9
+    for _, size, path in entries:
+        if total <= target:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+    logger.info(f"Thumbnail cache pruned to {total / 1024**2:.1f} MB")
+
+
+def _run_thumbnail_prune():
+    try:
+        _prune_thumbnail_cache(settings.thumbnail_cache_max_bytes)
+    except Exception:
+        logger.exception("Thumbnail cache prune failed")
+
+
+def schedule_thumbnail_prune():
+    """在后台线程中清理缩略图缓存（已有清理在进行时不重复启动），服务启动时与写入累计到阈值时调用"""
+    global _prune_thread
+    with _thumbnail_lock:
+        if _prune_thread is not None and _prune_thread.is_alive():
+            return
+        _prune_thread = Thread(
+            target=_run_thumbnail_prune, name="thumbnail-prune", daemon=True
+        )
+        _prune_thread.start()
+
+
+def get_frame_thumbnail(file_path: str, max_side: int, quality: int) -> str:
+    """返回帧缩略图的缓存路径，不存在或源文件已变化时重新生成
+
+    每个源文件与参数组合只对应一个缓存文件（缩略图的mtime与源文件一致即视为有效），
+    源文件变化时原地覆盖；缓存总大小超过thumbnail_cache_max_bytes时由后台线程淘汰最早写入的缩略图。
+    """
+    global _thumbnail_bytes_written
+
+    st = os.stat(file_path)
+    key = f"{os.path.abspath(file_path)}|{max_side}|{quality}"
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+    cache_dir = os.path.join(settings.thumbnail_cache_dir, digest[:2])
+    thumb_path = os.path.join(cache_dir, f"{digest}.jpg")
+    try:
+        if os.stat(thumb_path).st_mtime_ns == st.st_mtime_ns:
+            return thumb_path
+    except FileNotFoundError:
+        pass
+
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    os.close(fd)
+    try:
+        save_thumbnail(file_path, tmp_path, max_side, quality)
+        os.utime(tmp_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        written = os.path.getsize(tmp_path)
+        os.replace(tmp_path, thumb_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    with _thumbnail_lock:
+        _thumbnail_bytes_written += written
+        prune = (
+            _thumbnail_bytes_written
+            >= settings.thumbnail_cache_max_bytes * THUMBNAIL_PRUNE_FRACTION
+        )
+        if prune:
+            _thumbnail_bytes_written = 0
+    if prune:
+        schedule_thumbnail_prune()
+    return thumb_path
+
+
+def ingest_video(req: IngestVideoRequest, on_progress=None):
+    """按请求的fps与分辨率抽帧入库，返回帧目录信息"""
+    if not os.path.isfile(req.video_path):
+        raise FileNotFoundError(f"视频文件不存在: {req.video_path}")
+
+    # 帧数取ffmpeg实际输出的帧数（最后一次进度回调）
+    written = [0]
+
+    def track_progress(done):
+        written[0] = done
+        if on_progress is not None:
+            on_progress(done)
 
-    for ext in image_extensions:
-        pattern = (
-            os.path.join(folder_path, f"**/{ext}") if folder_path != "" else f"**/{ext}"
+    try:
+        output_dir = extract_frames_from_video(
+            req.video_path,
+            output_dir=req.output_dir,
+            fps=req.fps,
+            width=req.width,
+            height=req.height,
+            quality=req.quality,
+            on_progress=track_progress,
+            overwrite=req.overwrite,
         )
-        files = glob.glob(pattern, recursive=True)
-
-        for file_path in files:
-            filename = os.path.basename(file_path)
-            frames.append(
-                {
-                    "index": len(frames),
-                    "filename": filename,
-                    "file_path": file_path,
-                    "relative_path": (
-                        os.path.relpath(file_path, folder_path)
-                        if folder_path != ""
-                        else file_path
-                    ),
-                }
-            )
-
-    frames.sort(key=lambda x: x["filename"])
-    for i, frame in enumerate(frames):
-        frame["index"] = i
-
-    return frames
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(
+            f"ffmpeg抽帧失败(exit {e.returncode}): {(e.stderr or '').strip()}"
+        ) from e
+    folder_index.invalidate(os.path.abspath(output_dir))
+    frame_count = written[0]
+    logger.info(f"Ingested {req.video_path} -> {output_dir}: {frame_count} frames")
+    return {
+        "success": True,
+        "video_path": req.video_path,
+        "output_dir": output_dir,
+        "frame_count": frame_count,
+        "fps": req.fps,
+        "width": req.width,
+        "height": req.height,
+    }
@@ -1,8 +1,14 @@
+import uuid
+from collections import defaultdict
+from threading import Lock
+from typing import Any, Callable, Dict, List, Optional
+
 import torch
 from config.settings import settings
 from loguru import logger
 from qwen_vl_utils import process_vision_info
 from transformers import AutoProcessor
+from utils.mm_cache import FrameArrayCache, VisionInputCache
 from vllm import LLM, SamplingParams
 
 from sam2.build_sam import build_sam2, build_sam2_video_predictor
@@ -12,6 +18,14 @@ from sam2.sam2_image_predictor import SAM2ImagePredictor
 class ModelService:
     def __init__(self):
         self.models = {}
+        # 模型实例有状态且非线程安全，同一模型的调用需串行
+        self.locks = defaultdict(Lock)
+        self.vision_cache = VisionInputCache(settings.vision_input_cache_bytes)
+        self.frame_cache = FrameArrayCache(
+            settings.frame_cache_bytes,
+            disk_dir=settings.frame_cache_dir,
+            workers=settings.frame_decode_workers,
+        )
 
     def _load_sam2_models(self):
         """加载SAM2视频和图像分割模型"""
@@ -44,6 +58,7 @@ class ModelService:
                 tensor_parallel_size=settings.tensor_parallel_size,
                 mm_encoder_tp_mode=settings.mm_encoder_tp_mode,
                 seed=settings.llm_seed,
+                enable_prefix_caching=settings.enable_prefix_caching,
             )
 
             logger.info("Qwen-VL模型加载成功")
@@ -60,6 +75,10 @@ class ModelService:
         """获取指定类型的模型"""
         return self.models.get(model_type)
 
+    def lock(self, model_type) -> Lock:
+        """获取指定模型的互斥锁"""
+        return self.locks[model_type]
+
     def get_qwen_processor(self):
         """获取Qwen-VL处理器"""
         return self.models.get("qwen_processor")
@@ -68,19 +87,38 @@ class ModelService:
         """获取Qwen-VL LLM实例"""
         return self.models.get("qwen_llm")
 
-    def inference(self, messages) -> str:
-        """准备Qwen-VL推理输入"""
+    def vision_patch_factor(self) -> int:
+        """合并后视觉token对应的像素边长（patch_size * merge_size）；处理器未加载时取配置"""
+        processor = self.get_qwen_processor()
+        if processor is None:
+            return settings.vision_patch_size * 2
+        image_processor = processor.image_processor
+        return image_processor.patch_size * getattr(image_processor, "merge_size", 2)
+
+    def prepare_inputs(self, messages) -> Dict[str, Any]:
+        """构建单条消息的vLLM输入
+
+        消息应把全部帧放在提问文本之前，使同一批帧上的不同提问共享prompt前缀；
+        帧的预处理结果按(路径, mtime, 缩放参数)缓存，追问时不再重复解码缩放；
+        未命中时本地帧从按内容寻址的帧数组缓存读取，缺失的帧并行解码。
+        """
         processor = self.get_qwen_processor()
+        patch_size = processor.image_processor.patch_size
+        patch_factor = self.vision_patch_factor()
 
         text = processor.apply_chat_template(
             messages, tokenize=False, add_generation_prompt=True
         )
 
-        image_inputs, video_inputs, video_kwargs = process_vision_info(
+        image_inputs, video_inputs, video_kwargs = self.vision_cache.get_or_process(
             messages,
-            image_patch_size=processor.image_processor.patch_size,
-            return_video_kwargs=True,
-            return_video_metadata=True,
+            lambda msgs: process_vision_info(
+                self.frame_cache.materialize(msgs, patch_factor),
+                image_patch_size=patch_size,
+                return_video_kwargs=True,
+                return_video_metadata=True,
+            ),
+            patch_size,
         )
 
         mm_data = {}
@@ -89,7 +127,15 @@ class ModelService:
         if video_inputs is not None:
             mm_data["video"] = video_inputs
 
-        sampling_params = SamplingParams(
+        return {
+            "prompt": text,
+            "multi_modal_data": mm_data,
+            "mm_processor_kwargs": video_kwargs,
+        }
+
+    def get_sampling_params(self) -> SamplingParams:
+        """构建Qwen-VL采样参数"""
+        return SamplingParams(
             temperature=settings.temperature,
             max_tokens=settings.max_new_tokens,
             seed=settings.llm_seed,
@@ -99,16 +145,59 @@ class ModelService:
             presence_penalty=settings.presence_penalty,
             stop_token_ids=[],
         )
+
+    def batch_inference(
+        self,
+        messages_list: List[List[Dict]],
+        on_delta: Optional[Callable[[int, str], None]] = None,
+    ) -> List[str]:
+        """多条消息共享一次推理调用，按输入顺序返回文本
+
+        传入on_delta时以流式方式解码，每产生新文本即调用on_delta(消息序号, 增量文本)。
+        """
+        inputs = [self.prepare_inputs(messages) for messages in messages_list]
         llm = self.get_qwen_llm()
-        inputs = [
-            {
-                "prompt": text,
-                "multi_modal_data": mm_data,
-                "mm_processor_kwargs": video_kwargs,
-            }
-        ]
-        outputs = llm.generate(inputs, sampling_params=sampling_params)
-        return outputs[0].outputs[0].text
+        sampling_params = self.get_sampling_params()
+        with self.lock("qwen_llm"):
+            if on_delta is None:
+                outputs = llm.generate(inputs, sampling_params=sampling_params)
+                return [output.outputs[0].text for output in outputs]
+            return self._stream_generate(llm, inputs, sampling_params, on_delta)
+
+    def _stream_generate(self, llm, inputs, sampling_params, on_delta) -> List[str]:
+        """直接驱动已加载LLM的引擎逐步解码，避免再加载一份异步引擎权重"""
+        engine = llm.llm_engine
+        request_ids = [f"stream-{uuid.uuid4().hex}" for _ in inputs]
+        index_of = {request_id: i for i, request_id in enumerate(request_ids)}
+        texts = [""] * len(inputs)
+        unfinished = set()
+
+        try:
+            for request_id, prompt in zip(request_ids, inputs):
+                engine.add_request(request_id, prompt, sampling_params)
+                unfinished.add(request_id)
+
+            while engine.has_unfinished_requests():
+                for output in engine.step():
+                    i = index_of.get(output.request_id)
+                    if i is None:
+                        continue
+                    if output.finished:
+                        unfinished.discard(output.request_id)
+                    text = output.outputs[0].text
+                    if len(text) > len(texts[i]):
+                        on_delta(i, text[len(texts[i]) :])
+                    texts[i] = text
+        finally:
+            # 出错时中止本批残留的请求，否则它们会留在共享引擎中被后续generate一并取出
+            if unfinished:
+                engine.abort_request(list(unfinished))
+
+        return texts
+
+    def inference(self, messages) -> str:
+        """单条消息Qwen-VL推理"""
+        return self.batch_inference([messages])[0]
 
     def cleanup(self):
         """清理模型资源"""
@@ -1,15 +1,147 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
+import torch
+from config.settings import settings
 from loguru import logger
-from models.schemas import SegmentBatchRequest, SegmentRequest
+from models.schemas import (PropagateRequest, SegmentBatchRequest,
+                            SegmentRequest)
 from PIL import Image
+from services.file_service import scan_folder_for_frames
 from services.model_service import model_service
-from utils.image_utils import encode_image_to_base64, overlay_mask
+from utils.cache_utils import LRUByteCache
+from utils.image_utils import (composite_masks, encode_image_to_base64,
+                               encode_label_map_png, encode_masks_rle)
 from utils.video_utils import extract_frames_from_video
 
 
+def _features_nbytes(features) -> int:
+    tensors = [features["image_embed"], *features["high_res_feats"]]
+    return sum(t.element_size() * t.nelement() for t in tensors)
+
+
+def _features_to(features, device):
+    return {
+        "image_embed": features["image_embed"].to(device),
+        "high_res_feats": [f.to(device) for f in features["high_res_feats"]],
+        "orig_hw": features["orig_hw"],
+    }
+
+
+class EmbeddingCache:
+    """SAM2图像特征缓存，键为(路径, mtime, 文件大小)
+
+    设备上的特征按字节预算LRU淘汰；被淘汰的特征可溢出到CPU内存，命中时再搬回设备。
+    """
+
+    def __init__(self, device_bytes: int, cpu_bytes: int = 0):
+        self.cpu_cache = (
+            LRUByteCache(cpu_bytes, sizeof=_features_nbytes) if cpu_bytes > 0 else None
+        )
+        self.device_cache = LRUByteCache(
+            device_bytes,
+            sizeof=_features_nbytes,
+            on_evict=self._spill if self.cpu_cache is not None else None,
+        )
+
+    @staticmethod
+    def key_for(image_path: str):
+        st = os.stat(image_path)
+        return (os.path.abspath(image_path), st.st_mtime_ns, st.st_size)
+
+    def _spill(self, key, features):
+        self.cpu_cache.put(key, _features_to(features, "cpu"))
+
+    def get(self, key, device):
+        features = self.device_cache.get(key)
+        if features is None and self.cpu_cache is not None:
+            features = self.cpu_cache.pop(key)
+            if features is not None:
+                features = _features_to(features, device)
+                self.device_cache.put(key, features)
+        return features
+
+    def put(self, key, features):
+        self.device_cache.put(key, features)
+
+    @staticmethod
+    def export(predictor, index: int = 0):
+        """从已set_image的预测器中取出第index张图像的特征"""
+        image_features = predictor._features
+        return {
+            "image_embed": image_features["image_embed"][index : index + 1].clone(),
+            "high_res_feats": [
+                f[index : index + 1].clone() for f in image_features["high_res_feats"]
+            ],
+            "orig_hw": predictor._orig_hw[index],
+        }
+
+    @staticmethod
+    def restore(predictor, features_list, batch: bool):
+        """把缓存特征写回预测器，效果等同于对这些图像调用set_image/set_image_batch"""
+        predictor.reset_predictor()
+        predictor._features = {
+            "image_embed": torch.cat([f["image_embed"] for f in features_list]),
+            "high_res_feats": [
+                torch.cat(level)
+                for level in zip(*(f["high_res_feats"] for f in features_list))
+            ],
+        }
+        predictor._orig_hw = [f["orig_hw"] for f in features_list]
+        predictor._is_batch = batch
+        predictor._is_image_set = True
+
+    def stats(self) -> dict:
+        return {
+            "device": self.device_cache.stats(),
+            "cpu": self.cpu_cache.stats() if self.cpu_cache is not None else None,
+        }
+
+
 class SegmentationService:
+    def __init__(self):
+        self.embedding_cache = EmbeddingCache(
+            settings.sam2_embedding_cache_bytes,
+            settings.sam2_embedding_cache_cpu_bytes,
+        )
+
+    def _set_images_cached(self, predictor, image_paths, images, batch: bool):
+        """为预测器设置图像特征，已缓存的帧跳过图像编码器；需在模型锁内调用"""
+        keys = [self.embedding_cache.key_for(path) for path in image_paths]
+        features_list = [self.embedding_cache.get(key, predictor.device) for key in keys]
+
+        misses = [j for j, features in enumerate(features_list) if features is None]
+        if misses:
+            if batch:
+                predictor.set_image_batch([images[j] for j in misses])
+            else:
+                predictor.set_image(images[misses[0]])
+            for n, j in enumerate(misses):
+                features_list[j] = self.embedding_cache.export(predictor, n)
+                self.embedding_cache.put(keys[j], features_list[j])
+
+        if len(misses) < len(features_list):
+            self.embedding_cache.restore(predictor, features_list, batch)
+
+    def _load_rgb(self, image_path: str) -> np.ndarray:
+        """读取图像并转换为RGB数组"""
+        with Image.open(image_path) as image:
+            return np.array(image.convert("RGB"))
+
+    def _compose_overlay(self, image: np.ndarray, obj_ids, masks) -> np.ndarray:
+        """将各目标掩码一次性叠加到图像上（重叠处obj_id大者在上）"""
+        masks = masks.reshape(-1, *masks.shape[-2:])
+        return composite_masks(image, masks, list(obj_ids))
+
+    def _encode_frame_result(self, image, obj_ids, masks, output_format: str):
+        """按output_format编码单帧分割结果；rle/png格式不需要原图"""
+        if output_format == "rle":
+            return encode_masks_rle(masks, obj_ids)
+        if output_format == "png":
+            return encode_label_map_png(masks, obj_ids)
+        return encode_image_to_base64(self._compose_overlay(image, obj_ids, masks))
+
     def segment_image(self, req: SegmentRequest):
         """单图像多框分割"""
         try:
@@ -17,68 +149,89 @@ class SegmentationService:
             if not os.path.exists(image_path):
                 raise ValueError(f"Image file does not exist: {image_path}")
 
-            image = Image.open(image_path)
-            image = np.array(image.convert("RGB"))
+            image = self._load_rgb(image_path)
 
             image_predictor = model_service.get_model("image_predictor")
-            image_predictor.set_image(image)
-
             input_boxes = np.array(req.bboxes, dtype=np.float32)
-            masks, scores, _ = image_predictor.predict(
-                point_coords=None,
-                point_labels=None,
-                box=input_boxes,
-                multimask_output=False,
-            )
-
-            masks = masks.squeeze(1)
-            mask_data = list(zip(req.obj_ids, masks))
-            mask_data.sort(key=lambda x: x[0])
-
-            combined_overlay = image.copy()
-            for obj_id, mask in mask_data:
-                combined_overlay = overlay_mask(combined_overlay, mask, obj_id)
+            with model_service.lock("image_predictor"):
+                self._set_images_cached(
+                    image_predictor, [image_path], [image], batch=False
+                )
+                masks, scores, _ = image_predictor.predict(
+                    point_coords=None,
+                    point_labels=None,
+                    box=input_boxes,
+                    multimask_output=False,
+                )
 
-            return {str(req.frame_idx): encode_image_to_base64(combined_overlay)}
+            return {
+                str(req.frame_idx): self._encode_frame_result(
+                    image, req.obj_ids, masks, req.output_format
+                )
+            }
 
         except Exception as e:
             logger.error(f"Multi-box image segmentation failed: {str(e)}")
             raise
 
-    def segment_images(self, req: SegmentBatchRequest):
-        """批量图像分割"""
+    def segment_images(self, req: SegmentBatchRequest, on_frame=None):
+        """批量图像分割，每完成一帧调用一次on_frame(帧序号)
+
+        frame_indices 为 scan_folder 返回的帧序号。帧在线程池中并行解码（预取下一批），
+        每 sam2_batch_size 帧调用一次 set_image_batch/predict_batch。
+        """
         try:
-            results = {}
-            for i, (frame_idx, obj_ids, bboxes) in enumerate(
-                zip(req.frame_indices, req.obj_ids_list, req.bboxes_list)
-            ):
-                image_path = os.path.join(req.video_path, req.filename)
-                if not os.path.exists(image_path):
-                    raise ValueError(f"Image file does not exist: {req.video_path}")
+            frames = scan_folder_for_frames(req.video_path)
+            image_paths = []
+            for frame_idx in req.frame_indices:
+                if not 0 <= frame_idx < len(frames):
+                    raise ValueError(
+                        f"Frame index {frame_idx} out of range: {req.video_path}"
+                    )
+                image_paths.append(frames[frame_idx]["file_path"])
 
-                image = Image.open(image_path)
-                image = np.array(image.convert("RGB"))
+            batch_size = max(1, settings.sam2_batch_size)
+            chunks = [
+                range(start, min(start + batch_size, len(image_paths)))
+                for start in range(0, len(image_paths), batch_size)
+            ]
+            image_predictor = model_service.get_model("image_predictor")
 
-                image_predictor = model_service.get_model("image_predictor")
-                image_predictor.set_image(image)
+            results = {}
+            with ThreadPoolExecutor(max_workers=settings.sam2_decode_workers) as pool:
 
-                input_boxes = np.array(bboxes, dtype=np.float32)
-                masks, scores, _ = image_predictor.predict(
-                    point_coords=None,
-                    point_labels=None,
-                    box=input_boxes,
-                    multimask_output=False,
-                )
+                def prefetch(chunk):
+                    return [pool.submit(self._load_rgb, image_paths[i]) for i in chunk]
 
-                masks = masks.squeeze(1)
-                mask_data = list(zip(obj_ids, masks))
-                mask_data.sort(key=lambda x: x[0])
+                futures = prefetch(chunks[0]) if chunks else []
+                for k, chunk in enumerate(chunks):
+                    images = [future.result() for future in futures]
+                    if k + 1 < len(chunks):
+                        futures = prefetch(chunks[k + 1])
 
-                combined_overlay = image.copy()
-                for obj_id, mask in mask_data:
-                    combined_overlay = overlay_mask(combined_overlay, mask, obj_id)
+                    box_batch = [
+                        np.array(req.bboxes_list[i], dtype=np.float32) for i in chunk
+                    ]
+                    with model_service.lock("image_predictor"):
+                        self._set_images_cached(
+                            image_predictor,
+                            [image_paths[i] for i in chunk],
+                            images,
+                            batch=True,
+                        )
+                        masks_batch, scores_batch, _ = image_predictor.predict_batch(
+                            point_coords_batch=None,
+                            point_labels_batch=None,
+                            box_batch=box_batch,
+                            multimask_output=False,
+                        )
 
-                results[i] = encode_image_to_base64(combined_overlay)
+                    for i, image, masks in zip(chunk, images, masks_batch):
+                        results[i] = self._encode_frame_result(
+                            image, req.obj_ids_list[i], masks, req.output_format
+                        )
+                        if on_frame is not None:
+                            on_frame(i)
 
             return results
 
@@ -86,5 +239,67 @@ class SegmentationService:
             logger.error(f"Batch image segmentation failed: {str(e)}")
             raise
 
+    def _list_video_frames(self, video_dir: str):
+        """按SAM2 init_state相同的规则列出帧文件（文件名为帧序号）"""
+        frame_names = [
+            p
+            for p in os.listdir(video_dir)
+            if os.path.splitext(p)[-1] in [".jpg", ".jpeg", ".JPG", ".JPEG"]
+        ]
+        frame_names.sort(key=lambda p: int(os.path.splitext(p)[0]))
+        return [os.path.join(video_dir, p) for p in frame_names]
+
+    def propagate(self, req: PropagateRequest, on_frame=None):
+        """在关键帧上添加框提示，用SAM2视频预测器把掩码传播到整个帧目录"""
+        try:
+            if not os.path.isdir(req.video_path):
+                raise ValueError(f"Frame folder does not exist: {req.video_path}")
+            frame_paths = self._list_video_frames(req.video_path)
+
+            video_predictor = model_service.get_model("video_predictor")
+            results = {}
+            with model_service.lock("video_predictor"), torch.inference_mode():
+                state = video_predictor.init_state(
+                    video_path=req.video_path,
+                    offload_video_to_cpu=settings.propagation_offload_video_to_cpu,
+                    offload_state_to_cpu=settings.propagation_offload_state_to_cpu,
+                )
+
+                for prompt in req.prompts:
+                    if len(prompt.obj_ids) != len(prompt.bboxes):
+                        raise ValueError(
+                            f"obj_ids and bboxes length mismatch on frame {prompt.frame_idx}"
+                        )
+                    for obj_id, bbox in zip(prompt.obj_ids, prompt.bboxes):
+                        video_predictor.add_new_points_or_box(
+                            inference_state=state,
+                            frame_idx=prompt.frame_idx,
+                            obj_id=obj_id,
+                            box=np.array(bbox, dtype=np.float32),
+                        )
+
+                for frame_idx, obj_ids, mask_logits in video_predictor.propagate_in_video(
+                    state,
+                    start_frame_idx=req.start_frame_idx,
+                    max_frame_num_to_track=req.max_frame_num_to_track,
+                    reverse=req.reverse,
+                ):
+                    # 掩码留在设备上，由composite_masks直接在GPU上合成
+                    masks = mask_logits > 0.0
+                    image = None
+                    if req.output_format == "overlay":
+                        image = self._load_rgb(frame_paths[frame_idx])
+                    results[str(frame_idx)] = self._encode_frame_result(
+                        image, obj_ids, masks, req.output_format
+                    )
+                    if on_frame is not None:
+                        on_frame(frame_idx)
+
+            return results
+
+        except Exception as e:
+            logger.error(f"Video mask propagation failed: {str(e)}")
+            raise
+
 
 segmentation_service = SegmentationService()
@@ -1,69 +1,152 @@
 # services/vision_analysis_service.py
+import bisect
 import math
 import os
 import re
-from typing import Any, Dict, List
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
-import natsort
 import numpy as np
+from config.settings import settings
 from loguru import logger
-from models.schemas import VisionAnalysisRequest
+from models.schemas import VideoAnalysisRequest, VisionAnalysisRequest
+from PIL import Image
+from services.file_service import folder_index
 from services.model_service import model_service
+from utils.frame_planner import TokenBudgetExceeded, frame_tokens, plan_frames
 from utils.image_utils import decode_base64_to_image, encode_image_to_base64
-from utils.vision_utils import draw_bounding_boxes, parse_json_from_response
+from utils.keyframes import FrameSignatureCache
+from utils.video_utils import is_video_file, probe_video, read_video_frames
+from utils.vision_utils import (IncrementalJSONArrayParser,
+                                build_detection_grids, draw_bounding_boxes,
+                                load_image_from_source,
+                                merge_window_detections,
+                                parse_json_from_response)
 
 
 class VisionAnalysisService:
+    def __init__(self):
+        self.signature_cache = FrameSignatureCache(
+            settings.frame_decode_workers, settings.signature_cache_bytes
+        )
 
-    def generate_image_content(
-        self, folder_path: str, orig_fps: float, target_fps: float, total_frames: int
+    @staticmethod
+    def _timestamped_content(
+        seconds: List[float],
+        images: List[Any],
+        width: Optional[int] = None,
+        height: Optional[int] = None,
     ) -> List[Dict]:
-        """从视频帧文件夹中按目标帧率采样图像并生成带时间戳的消息列表"""
-        folder_path = os.path.abspath(folder_path)
+        """交替排列时间戳文本与图像（路径或PIL图像），尺寸默认取图像分析的缩放尺寸"""
+        width = width or settings.vision_image_width
+        height = height or settings.vision_image_height
+        message_content = []
+        for sec, image in zip(seconds, images):
+            message_content.append({"type": "text", "text": f"<{sec:.2f} seconds>"})
+            message_content.append(
+                {
+                    "type": "image",
+                    "image": image,
+                    "resized_width": width,
+                    "resized_height": height,
+                }
+            )
+        return message_content
 
-        jpg_files = [f for f in os.listdir(folder_path) if f.lower().endswith(".jpg")]
-        jpg_files = natsort.natsorted(jpg_files)
-        total_available = len(jpg_files)
+    @staticmethod
+    def token_budget() -> int:
+        """单条消息中视觉输入可用的token数"""
+        return (
+            settings.max_model_len
+            - settings.max_new_tokens
+            - settings.prompt_token_reserve
+        )
+
+    def plan_frames(
+        self,
+        video_dir: str,
+        original_fps: float,
+        target_fps: float,
+        frames_needed: int,
+        window_frames: Optional[int] = None,
+        strict: bool = False,
+        sampling: str = "uniform",
+    ) -> Dict[str, Any]:
+        """按上下文预算规划采样帧序号与分辨率；video_dir可以是帧目录或视频文件（帧率取自文件）
 
-        if total_available == 0:
-            raise ValueError(f"在文件夹 {folder_path} 中未找到.jpg文件")
+        sampling为"motion"时按帧签名的变化量把帧预算集中到画面变化剧烈的区间（仅帧目录）。
+        """
+        scores = None
+        if is_video_file(video_dir):
+            orig_fps, total_available, width, height = probe_video(video_dir)
+            if sampling == "motion":
+                logger.warning("视频文件不支持按画面变化选帧，改为均匀采样")
+        else:
+            folder_path = os.path.abspath(video_dir)
+            jpg_files = folder_index.jpg_files(folder_path)
+            if not jpg_files:
+                raise ValueError(f"在文件夹 {folder_path} 中未找到.jpg文件")
+            orig_fps, total_available = original_fps, len(jpg_files)
+            with Image.open(os.path.join(folder_path, jpg_files[0])) as img:
+                width, height = img.size
+            if sampling == "motion":
+                scores = self.signature_cache.change_scores(folder_path, jpg_files)
 
-        if total_frames > total_available:
+        if frames_needed > total_available:
             logger.warning(
-                f"所需帧数({total_frames})超过实际({total_available})，已调整为{total_available}"
+                f"所需帧数({frames_needed})超过实际({total_available})，已调整为{total_available}"
             )
-            total_frames = total_available
-
-        if target_fps > orig_fps:
-            raise ValueError(f"目标帧率({target_fps})不能大于原始帧率({orig_fps})")
+            frames_needed = total_available
 
-        if total_frames == 1:
-            selected_indices = [0]
-        else:
-            step = (total_available - 1) // (total_frames - 1)
-            selected_indices = [i * step for i in range(total_frames)]
-            selected_indices = [
-                min(idx, total_available - 1) for idx in selected_indices
-            ]
-
-        image_paths = [
-            os.path.join(folder_path, jpg_files[i]) for i in selected_indices
-        ]
-        seconds = [i / orig_fps for i in selected_indices]
+        plan = plan_frames(
+            total_available,
+            orig_fps,
+            target_fps,
+            frames_needed,
+            self.token_budget(),
+            model_service.vision_patch_factor(),
+            (width, height),
+            max_side=settings.frame_plan_max_side,
+            min_side=settings.frame_plan_min_side,
+            window_frames=window_frames,
+            strict=strict,
+            change_scores=scores,
+        )
+        logger.info(
+            f"帧规划: 共{len(plan['indices'])}帧, {plan['width']}x{plan['height']}, "
+            f"每条消息{plan['frames_per_context']}帧约{plan['visual_tokens']}个视觉token"
+            f"(预算{plan['token_budget']})"
+        )
+        return plan
 
-        message_content = []
-        for sec, img_path in zip(seconds, image_paths):
-            message_content.append({"type": "text", "text": f"<{sec:.2f} seconds>"})
-            message_content.append(
-                {
-                    "type": "image",
-                    "image": f"file://{img_path}",
-                    "resized_width": 640,
-                    "resized_height": 360,
-                }
+    def sample_frames(self, video_dir: str, plan: Dict[str, Any]) -> List[Any]:
+        """读取规划中的帧：帧目录返回file://路径，视频文件直接解码为PIL图像（不落盘）"""
+        if is_video_file(video_dir):
+            return read_video_frames(
+                video_dir, plan["indices"], plan["width"], plan["height"]
             )
 
-        return message_content
+        folder_path = os.path.abspath(video_dir)
+        jpg_files = folder_index.jpg_files(folder_path)
+        return [f"file://{os.path.join(folder_path, jpg_files[i])}" for i in plan["indices"]]
+
+    def generate_image_content(
+        self,
+        folder_path: str,
+        orig_fps: float,
+        target_fps: float,
+        total_frames: int,
+        sampling: str = "uniform",
+    ) -> List[Dict]:
+        """从视频帧文件夹中按目标帧率采样图像并生成带时间戳的消息列表"""
+        plan = self.plan_frames(
+            folder_path, orig_fps, target_fps, total_frames, sampling=sampling
+        )
+        return self._timestamped_content(
+            plan["seconds"],
+            self.sample_frames(folder_path, plan),
+            plan["width"],
+            plan["height"],
+        )
 
     def get_messages_with_images(
         self,
@@ -72,28 +155,160 @@ class VisionAnalysisService:
         original_fps: float = 12.5,
         target_fps: float = 2,
         frames_needed: int = 100,
+        sampling: str = "uniform",
     ) -> List[Dict]:
-        """构建包含视频帧和用户提示的完整消息"""
-        images_content = self.generate_image_content(
-            video_dir, original_fps, target_fps, frames_needed
+        """构建包含视频帧和用户提示的完整消息；video_dir也可以是视频文件（帧率取自文件）"""
+        plan = self.plan_frames(
+            video_dir, original_fps, target_fps, frames_needed, sampling=sampling
         )
+        images = self.sample_frames(video_dir, plan)
+        return self._build_messages(plan, plan["seconds"], images, user_prompt)
 
-        messages = [
+    def _build_messages(
+        self, plan: Dict[str, Any], seconds: List[float], images: List[Any], user_prompt: str
+    ) -> List[Dict]:
+        return [
             {
                 "role": "user",
-                "content": [*images_content, {"type": "text", "text": user_prompt}],
+                "content": [
+                    *self._timestamped_content(
+                        seconds, images, plan["width"], plan["height"]
+                    ),
+                    {"type": "text", "text": user_prompt},
+                ],
             }
         ]
 
-        return messages
+    @staticmethod
+    def _split_windows(count: int, window: int, overlap: int) -> List[Tuple[int, int]]:
+        """把count帧切分为长window帧、相邻重叠overlap帧的窗口[start, end)，末窗口与结尾对齐"""
+        if count <= window:
+            return [(0, count)]
+        stride = max(1, window - overlap)
+        starts = list(range(0, count - window + 1, stride))
+        if starts[-1] + window < count:
+            starts.append(count - window)
+        return [(start, start + window) for start in starts]
 
-    def analyze_image(self, req: VisionAnalysisRequest) -> Dict[str, Any]:
-        """分析单张图像并返回带标注的结果"""
+    @staticmethod
+    def _frame_lookup(seconds: List[float], images: List[Any]):
+        """返回按时间戳取最近采样帧的函数，帧路径按需加载"""
+
+        def frame_for_time(t: float):
+            pos = bisect.bisect_left(seconds, t)
+            candidates = [i for i in (pos - 1, pos) if 0 <= i < len(seconds)]
+            if not candidates:
+                return None
+            image = images[min(candidates, key=lambda i: abs(seconds[i] - t))]
+            if isinstance(image, str):
+                with load_image_from_source(image) as img:
+                    return img.convert("RGB")
+            return image.copy()
+
+        return frame_for_time
+
+    def plan_video_request(
+        self, req: VideoAnalysisRequest, estimate_only: bool = False
+    ) -> Dict[str, Any]:
+        """视频分析请求的帧规划；显式指定的窗口帧数超出上下文预算时抛出TokenBudgetExceeded
+
+        estimate_only为True时只估计token数（帧数与分辨率不受选帧方式影响），跳过帧签名计算。
+        """
+        return self.plan_frames(
+            req.video_dir,
+            req.original_fps,
+            req.target_fps,
+            req.frames_needed,
+            window_frames=req.window_frames or settings.video_window_frames,
+            strict=req.window_frames is not None,
+            sampling="uniform" if estimate_only else req.sampling,
+        )
+
+    def estimate_image_request_tokens(self, req: VisionAnalysisRequest) -> int:
+        """估计图像分析请求的视觉token数，超出上下文预算时抛出TokenBudgetExceeded"""
+        tokens = len(req.base64_images) * frame_tokens(
+            settings.vision_image_width,
+            settings.vision_image_height,
+            model_service.vision_patch_factor(),
+        )
+        budget = self.token_budget()
+        if tokens > budget:
+            raise TokenBudgetExceeded(
+                f"{len(req.base64_images)}张图像约需{tokens}个视觉token，超出上下文预算{budget}"
+            )
+        return tokens
+
+    def analyze_video(self, req: VideoAnalysisRequest) -> Dict[str, Any]:
+        """长视频分析：按上下文预算切分为重叠的时间窗口，一次批量推理后按时间戳合并检测结果"""
+        plan = self.plan_video_request(req)
+        seconds = plan["seconds"]
+        images = self.sample_frames(req.video_dir, plan)
+
+        window = plan["frames_per_context"]
+        overlap = min(
+            settings.video_window_overlap
+            if req.window_overlap is None
+            else req.window_overlap,
+            window - 1,
+        )
+        windows = self._split_windows(len(seconds), window, overlap)
+        logger.info(
+            f"视频分析: {len(seconds)} 帧, {len(windows)} 个窗口 (每窗口{window}帧, 重叠{overlap}帧)"
+        )
+
+        responses = model_service.batch_inference(
+            [
+                self._build_messages(plan, seconds[s:e], images[s:e], req.user_prompt)
+                for s, e in windows
+            ]
+        )
+
+        window_results = []
+        for (s, e), response in zip(windows, responses):
+            try:
+                results = parse_json_from_response(response)
+            except Exception as ex:
+                logger.warning(
+                    f"窗口 {seconds[s]:.2f}-{seconds[e - 1]:.2f}s 输出解析失败: {ex}"
+                )
+                results = []
+            window_results.append(results if isinstance(results, list) else [])
+
+        results = merge_window_detections(
+            window_results, [(seconds[s], seconds[e - 1]) for s, e in windows]
+        )
+        grids = build_detection_grids(
+            results, self._frame_lookup(seconds, images), req.grid_size, req.columns
+        )
+
+        return {
+            "status": "success",
+            "results": results,
+            "grid_images": [encode_image_to_base64(np.array(grid)) for grid in grids],
+            "grid_count": len(grids),
+            "window_count": len(windows),
+            "frame_count": len(seconds),
+            "frame_plan": {
+                key: plan[key]
+                for key in (
+                    "width",
+                    "height",
+                    "tokens_per_frame",
+                    "frames_per_context",
+                    "visual_tokens",
+                    "token_budget",
+                )
+            },
+        }
+
+    def build_image_messages(self, req: VisionAnalysisRequest):
+        """将base64图像请求转换为Qwen-VL消息，返回消息和解码后的图像列表"""
 
         images_content = []
+        images = []
 
         for i, base64_image in enumerate(req.base64_images):
-            image = decode_base64_to_image(base64_image)
+            images.append(decode_base64_to_image(base64_image))
 
             image_url = f"data:image/jpeg;base64,{base64_image}"
 
@@ -103,12 +318,15 @@ class VisionAnalysisService:
                     {
                         "type": "image_url",
                         "image_url": image_url,
-                        "resized_width": 640,
-                        "resized_height": 360,
+                        "resized_width": settings.vision_image_width,
+                        "resized_height": settings.vision_image_height,
                     },
                 ]
             )
 
+        if not images:
+            raise ValueError("base64_images 不能为空")
+
         messages = [
             {
                 "role": "user",
@@ -119,9 +337,12 @@ class VisionAnalysisService:
             }
         ]
 
-        response = model_service.inference(messages)
+        return messages, images
+
+    def build_image_result(self, response: str, images) -> Dict[str, Any]:
+        """解析模型输出并生成带标注的结果"""
         results = parse_json_from_response(response)
-        annotated_image = draw_bounding_boxes(image.copy(), results)
+        annotated_image = draw_bounding_boxes(images[-1].copy(), results)
         annotated_base64 = encode_image_to_base64(np.array(annotated_image))
 
         return {
@@ -131,5 +352,78 @@ class VisionAnalysisService:
             "detection_count": len(results),
         }
 
+    def annotate_detection(self, images, detection: Dict) -> str:
+        """在检测结果对应时间戳的帧上绘制边界框，返回base64图像"""
+        try:
+            frame_idx = int(round(float(detection.get("time", len(images))))) - 1
+        except (TypeError, ValueError):
+            frame_idx = len(images) - 1
+        frame_idx = min(max(frame_idx, 0), len(images) - 1)
+
+        annotated_image = draw_bounding_boxes(images[frame_idx].copy(), [detection])
+        return encode_image_to_base64(np.array(annotated_image.convert("RGB")))
+
+    def analyze_images(
+        self,
+        reqs: List[VisionAnalysisRequest],
+        on_detection: Optional[Callable[[int, Dict, Optional[str]], None]] = None,
+    ) -> List[Union[Dict[str, Any], Exception]]:
+        """批量分析多个请求，共享一次推理调用；按顺序返回结果或对应的异常
+
+        若有请求开启stream且传入on_detection，则流式解码，每解析出一个检测对象
+        即调用on_detection(请求序号, 检测结果, 标注图像base64或None)。
+        """
+        outcomes: List[Union[Dict[str, Any], Exception]] = [None] * len(reqs)
+
+        prepared = []
+        for i, req in enumerate(reqs):
+            try:
+                messages, images = self.build_image_messages(req)
+                prepared.append((i, messages, images))
+            except Exception as e:
+                outcomes[i] = e
+
+        if not prepared:
+            return outcomes
+
+        on_delta = None
+        if on_detection is not None and any(reqs[i].stream for i, _, _ in prepared):
+            parsers = {}
+            for i, _, _ in prepared:
+                if reqs[i].stream:
+                    parsers[i] = IncrementalJSONArrayParser()
+
+            def on_delta(j, delta):
+                i, _, images = prepared[j]
+                if i not in parsers:
+                    return
+                for detection in parsers[i].feed(delta):
+                    try:
+                        annotated = None
+                        if reqs[i].stream_annotated:
+                            annotated = self.annotate_detection(images, detection)
+                        on_detection(i, detection, annotated)
+                    except Exception as e:
+                        # 单个异常检测结果不应中断整批流式解码
+                        logger.warning(f"推送检测结果失败: {detection}, {e}")
+
+        responses = model_service.batch_inference(
+            [messages for _, messages, _ in prepared], on_delta=on_delta
+        )
+        for (i, _, images), response in zip(prepared, responses):
+            try:
+                outcomes[i] = self.build_image_result(response, images)
+            except Exception as e:
+                outcomes[i] = e
+
+        return outcomes
+
+    def analyze_image(self, req: VisionAnalysisRequest) -> Dict[str, Any]:
+        """分析单张图像并返回带标注的结果"""
+        outcome = self.analyze_images([req])[0]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
 
 vision_service = VisionAnalysisService()
@@ -0,0 +1,92 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Callable, Hashable, Optional
+
+
+class LRUByteCache:
+    """按字节预算淘汰的线程安全LRU缓存
+
+    每个条目的大小由 put 时的 nbytes 或构造时的 sizeof(value) 给出；
+    总大小超过 max_bytes 时淘汰最久未使用的条目，并调用 on_evict(key, value)。
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        sizeof: Optional[Callable[[Any], int]] = None,
+        on_evict: Optional[Callable[[Hashable, Any], None]] = None,
+    ):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.on_evict = on_evict
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __contains__(self, key) -> bool:
+        return key in self._items
+
+    def get(self, key, default=None):
+        """读取条目并标记为最近使用"""
+        with self._lock:
+            if key not in self._items:
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+            return self._items[key][0]
+
+    def put(self, key, value, nbytes: Optional[int] = None) -> bool:
+        """写入条目；单个条目超过预算时不缓存并返回False"""
+        if nbytes is None:
+            nbytes = self.sizeof(value) if self.sizeof is not None else 0
+        if nbytes > self.max_bytes:
+            return False
+
+        evicted = []
+        with self._lock:
+            if key in self._items:
+                self.total_bytes -= self._items.pop(key)[1]
+            self._items[key] = (value, nbytes)
+            self.total_bytes += nbytes
+            while self.total_bytes > self.max_bytes:
+                old_key, (old_value, old_nbytes) = self._items.popitem(last=False)
+                self.total_bytes -= old_nbytes
+                self.evictions += 1
+                evicted.append((old_key, old_value))
+
+        if self.on_evict is not None:
+            for old_key, old_value in evicted:
+                self.on_evict(old_key, old_value)
+        return True
+
+    def pop(self, key, default=None):
+        """移除条目并返回其值（不计入淘汰）"""
+        with self._lock:
+            if key not in self._items:
+                return default
+            value, nbytes = self._items.pop(key)
+            self.total_bytes -= nbytes
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.total_bytes = 0
+
+    def stats(self) -> dict:
+        """缓存统计信息"""
+        return {
+            "entries": len(self._items),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
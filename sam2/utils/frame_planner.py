@@ -0,0 +1,126 @@
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from utils.keyframes import select_keyframes
+
+# 每帧除图像token外的开销：时间戳文本"<12.34 seconds>"与视觉起止标记的估计token数
+FRAME_TEXT_TOKENS = 12
+
+
+class TokenBudgetExceeded(ValueError):
+    """请求的帧在最小分辨率下仍超出上下文预算"""
+
+
+def sample_indices(
+    total_available: int, orig_fps: float, target_fps: float, max_frames: int
+) -> List[int]:
+    """按目标帧率采样帧序号，覆盖整段视频
+
+    按target_fps采样的帧数不超过max_frames时以1/target_fps为间隔取帧；
+    否则在整段视频上均匀取max_frames帧（四舍五入而非整除步长，不会挤在开头）。
+    """
+    if total_available <= 0 or max_frames <= 0:
+        return []
+    if target_fps > orig_fps:
+        raise ValueError(f"目标帧率({target_fps})不能大于原始帧率({orig_fps})")
+
+    step = orig_fps / target_fps
+    at_target_fps = int((total_available - 1) / step) + 1
+    if at_target_fps <= max_frames:
+        return [int(round(k * step)) for k in range(at_target_fps)]
+
+    if max_frames == 1:
+        return [0]
+    positions = np.linspace(0, total_available - 1, max_frames)
+    return np.unique(np.round(positions).astype(int)).tolist()
+
+
+def frame_tokens(width: int, height: int, patch_factor: int) -> int:
+    """单帧（按resized_width/height缩放）占用的token数，含时间戳文本开销"""
+    from qwen_vl_utils.vision_process import smart_resize
+
+    resized_height, resized_width = smart_resize(height, width, factor=patch_factor)
+    return (resized_height // patch_factor) * (
+        resized_width // patch_factor
+    ) + FRAME_TEXT_TOKENS
+
+
+def resolution_ladder(
+    source_size: Tuple[int, int], max_side: int, min_side: int, patch_factor: int
+) -> List[Tuple[int, int]]:
+    """保持源宽高比、长边从max_side逐级降到min_side（按patch_factor步进）的候选分辨率"""
+    src_width, src_height = source_size
+    ratio = min(src_width, src_height) / max(src_width, src_height)
+
+    ladder = []
+    long_side = max_side
+    while True:
+        short_side = max(patch_factor, int(round(long_side * ratio)))
+        size = (long_side, short_side) if src_width >= src_height else (short_side, long_side)
+        ladder.append(size)
+        if long_side <= min_side:
+            break
+        long_side = max(min_side, long_side - patch_factor)
+    return ladder
+
+
+def plan_frames(
+    total_available: int,
+    orig_fps: float,
+    target_fps: float,
+    max_frames: int,
+    token_budget: int,
+    patch_factor: int,
+    source_size: Tuple[int, int],
+    max_side: int = 640,
+    min_side: int = 256,
+    window_frames: Optional[int] = None,
+    strict: bool = False,
+    change_scores: Optional[np.ndarray] = None,
+) -> Dict:
+    """在上下文预算内选择帧数与分辨率，优先保证时间覆盖，其次才是单帧分辨率
+
+    同一上下文中的帧数为window_frames（不分窗口时为全部采样帧）；分辨率从max_side起
+    逐级降低直到放得下。降到min_side仍放不下时：strict为True抛出TokenBudgetExceeded，
+    否则减少帧数（不分窗口时仍覆盖整段视频，分窗口时缩小窗口）。
+
+    传入change_scores（每个源帧的画面变化量）时帧数不变，但不再均匀取帧，
+    而是在按target_fps采样的候选帧中把帧预算集中到变化剧烈的区间。
+    """
+    indices = sample_indices(total_available, orig_fps, target_fps, max_frames)
+    if not indices:
+        raise ValueError("没有可采样的帧")
+
+    per_context = len(indices) if window_frames is None else min(window_frames, len(indices))
+    for width, height in resolution_ladder(source_size, max_side, min_side, patch_factor):
+        tokens = frame_tokens(width, height, patch_factor)
+        if per_context * tokens <= token_budget:
+            break
+    else:
+        capacity = token_budget // tokens
+        if strict or capacity < 1:
+            raise TokenBudgetExceeded(
+                f"{per_context}帧在最小分辨率{width}x{height}下约需"
+                f"{per_context * tokens}个视觉token，超出上下文预算{token_budget}"
+            )
+        if window_frames is None:
+            indices = sample_indices(total_available, orig_fps, target_fps, capacity)
+            per_context = len(indices)
+        else:
+            per_context = capacity
+
+    if change_scores is not None:
+        candidates = sample_indices(total_available, orig_fps, target_fps, total_available)
+        indices = select_keyframes(candidates, change_scores, len(indices))
+
+    return {
+        "indices": indices,
+        "seconds": [i / orig_fps for i in indices],
+        "width": width,
+        "height": height,
+        "tokens_per_frame": tokens,
+        "frames_per_context": per_context,
+        "visual_tokens": per_context * tokens,
+        "total_visual_tokens": len(indices) * tokens,
+        "token_budget": token_budget,
+    }
@@ -2,9 +2,109 @@ import base64
 from io import BytesIO
 
 import numpy as np
+import torch
 from PIL import Image
 
 
+# 默认调色板（RGB, 0-255），obj_id 按取模循环取色
+DEFAULT_PALETTE = np.array(
+    [
+        [255, 0, 0],
+        [0, 255, 0],
+        [0, 0, 255],
+        [255, 255, 0],
+        [255, 0, 255],
+        [0, 255, 255],
+        [255, 128, 0],
+        [128, 0, 255],
+        [0, 128, 255],
+        [255, 0, 128],
+        [128, 255, 0],
+        [0, 255, 128],
+    ],
+    dtype=np.uint8,
+)
+
+
+def build_palette(obj_ids, use_random_color: bool = False) -> np.ndarray:
+    """为obj_id序列生成(N, 3) uint8调色板
+
+    结果只由obj_id决定，不读写numpy全局随机状态；obj_id为None时取第一种颜色。
+    """
+    colors = []
+    for obj_id in obj_ids:
+        if use_random_color:
+            rng = np.random.default_rng(0 if obj_id is None else obj_id % 1000)
+            colors.append(np.round(rng.random(3) * 255))
+        else:
+            index = 0 if obj_id is None else obj_id % len(DEFAULT_PALETTE)
+            colors.append(DEFAULT_PALETTE[index])
+    return np.array(colors, dtype=np.uint8).reshape(-1, 3)
+
+
+def composite_masks(
+    frame: np.ndarray,
+    masks,
+    obj_ids=None,
+    alpha: float = 0.4,
+    palette: np.ndarray = None,
+) -> np.ndarray:
+    """一次性把多个目标掩码叠加到图像上
+
+    Args:
+        frame: (H, W, 3) 图像
+        masks: (N, H, W) 掩码，numpy数组或torch张量（在GPU上时直接在GPU上合成），>0视为前景
+        obj_ids: 长度为N的目标ID，决定颜色与叠放顺序；默认0..N-1
+        alpha: 掩码颜色的不透明度
+        palette: (N, 3) 与masks一一对应的颜色，默认由build_palette(obj_ids)生成
+
+    重叠规则：像素只取覆盖它的obj_id最大的掩码的颜色，且只混合一次，
+    不会因多个掩码重叠而反复叠色。
+    """
+    frame = np.asarray(frame, dtype=np.uint8)
+    num_masks = masks.shape[0] if masks.ndim == 3 else 1
+    if num_masks == 0:
+        return frame.copy()
+    masks = masks.reshape(num_masks, *masks.shape[-2:])
+
+    if obj_ids is None:
+        obj_ids = list(range(num_masks))
+    if palette is None:
+        palette = build_palette(obj_ids)
+
+    # 按obj_id升序排列，最后一个覆盖该像素的掩码即为顶层
+    order = np.argsort(np.asarray(obj_ids), kind="stable")
+    palette = np.asarray(palette, dtype=np.float32)[order]
+
+    if torch.is_tensor(masks):
+        return _composite_masks_torch(frame, masks, order, palette, alpha)
+
+    masks_bool = np.asarray(masks)[order] > 0
+    covered = masks_bool.any(axis=0)
+    top = num_masks - 1 - np.argmax(masks_bool[::-1], axis=0)
+
+    out = frame.copy()
+    blended = frame[covered] * (1 - alpha) + palette[top[covered]] * alpha
+    out[covered] = np.clip(np.round(blended), 0, 255).astype(np.uint8)
+    return out
+
+
+def _composite_masks_torch(frame, masks, order, palette, alpha) -> np.ndarray:
+    """composite_masks 的torch实现，在掩码所在设备上完成合成"""
+    device = masks.device
+    num_masks = masks.shape[0]
+    masks_bool = masks[torch.from_numpy(order).to(device)] > 0
+    covered = masks_bool.any(dim=0)
+    top = num_masks - 1 - masks_bool.flip(0).to(torch.uint8).argmax(dim=0)
+
+    frame_t = torch.from_numpy(frame).to(device)
+    colors = torch.from_numpy(palette).to(device)[top]
+    blended = frame_t.float() * (1 - alpha) + colors * alpha
+    blended = blended.round().clamp(0, 255).to(torch.uint8)
+    out = torch.where(covered.unsqueeze(-1), blended, frame_t)
+    return out.cpu().numpy()
+
+
 def overlay_mask(
     frame: np.ndarray,
     mask: np.ndarray,
@@ -12,49 +112,87 @@ def overlay_mask(
     alpha: float = 0.4,
     use_random_color=False,
 ) -> np.ndarray:
-    """改进的掩码覆盖函数"""
+    """单个掩码覆盖，多个目标请使用composite_masks"""
     mask = mask.squeeze()
     assert len(mask.shape) == 2, "Mask should be 2D (H, W)"
 
-    def get_color(obj_id, use_random_color):
-        if use_random_color:
-            if obj_id is not None:
-                np.random.seed(obj_id % 1000)
-            return np.random.random(3)
-        else:
-            extended_colors = [
-                [1.0, 0.0, 0.0],
-                [0.0, 1.0, 0.0],
-                [0.0, 0.0, 1.0],
-                [1.0, 1.0, 0.0],
-                [1.0, 0.0, 1.0],
-                [0.0, 1.0, 1.0],
-                [1.0, 0.5, 0.0],
-                [0.5, 0.0, 1.0],
-                [0.0, 0.5, 1.0],
-                [1.0, 0.0, 0.5],
-                [0.5, 1.0, 0.0],
-                [0.0, 1.0, 0.5],
-            ]
-            if obj_id is None:
-                return np.array(extended_colors[0])
-            else:
-                color_idx = obj_id % len(extended_colors)
-                return np.array(extended_colors[color_idx])
-
-    color = get_color(obj_id, use_random_color)
-    frame = frame.astype(np.uint8)
-    out = frame.copy()
-    mask_bool = mask > 0
+    palette = build_palette([obj_id], use_random_color)
+    return composite_masks(frame, mask[None], [obj_id], alpha, palette)
 
-    for c in range(3):
-        out_channel = out[:, :, c].astype(np.float32)
-        out_channel[mask_bool] = (
-            out_channel[mask_bool] * (1 - alpha) + color[c] * 255 * alpha
-        )
-        out[:, :, c] = np.clip(out_channel, 0, 255).astype(np.uint8)
 
-    return out
+def _to_numpy_masks(masks) -> np.ndarray:
+    if torch.is_tensor(masks):
+        masks = masks.detach().cpu().numpy()
+    masks = np.asarray(masks)
+    return masks.reshape(-1, *masks.shape[-2:]) > 0
+
+
+def encode_mask_rle(mask: np.ndarray) -> dict:
+    """把二值掩码编码为COCO RLE（列优先）
+
+    安装了pycocotools时counts为压缩字符串，否则为未压缩的整数列表，两者均为COCO格式。
+    """
+    mask = np.asarray(mask, dtype=bool)
+    height, width = mask.shape
+
+    try:
+        from pycocotools import mask as mask_utils
+
+        rle = mask_utils.encode(np.asfortranarray(mask.astype(np.uint8)))
+        return {"size": [height, width], "counts": rle["counts"].decode("ascii")}
+    except ImportError:
+        pass
+
+    flat = mask.ravel(order="F")
+    change = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate([[0], change, [flat.size]])).tolist()
+    if flat.size and flat[0]:
+        # COCO RLE 以背景段开头
+        counts = [0] + counts
+    return {"size": [height, width], "counts": counts}
+
+
+def encode_masks_rle(masks, obj_ids) -> dict:
+    """每个目标一个COCO RLE"""
+    masks = _to_numpy_masks(masks)
+    return {
+        "format": "rle",
+        "objects": [
+            {"obj_id": int(obj_id), **encode_mask_rle(mask)}
+            for obj_id, mask in zip(obj_ids, masks)
+        ],
+    }
+
+
+def encode_label_map_png(masks, obj_ids) -> dict:
+    """把所有目标合成一张调色板PNG标签图（base64）
+
+    像素值0为背景，k表示labels[k-1]对应的目标；重叠处与composite_masks一致，
+    取obj_id最大的目标。调色板颜色与叠加图相同。
+    """
+    masks = _to_numpy_masks(masks)
+    obj_ids = [int(obj_id) for obj_id in obj_ids]
+    if len(obj_ids) > 255:
+        raise ValueError("PNG label map supports at most 255 objects")
+
+    order = np.argsort(np.asarray(obj_ids), kind="stable")
+    label_map = np.zeros(masks.shape[-2:], dtype=np.uint8)
+    for rank, j in enumerate(order, start=1):
+        label_map[masks[j]] = rank
+    labels = [obj_ids[j] for j in order]
+
+    image = Image.fromarray(label_map, mode="P")
+    palette = np.zeros((256, 3), dtype=np.uint8)
+    palette[1 : len(labels) + 1] = build_palette(labels)
+    image.putpalette(palette.ravel().tolist())
+
+    buf = BytesIO()
+    image.save(buf, format="PNG")
+    return {
+        "format": "png",
+        "label_map": base64.b64encode(buf.getvalue()).decode("utf-8"),
+        "labels": labels,
+    }
 
 
 def encode_image_to_base64(img_array: np.ndarray) -> str:
@@ -70,3 +208,17 @@ def decode_base64_to_image(base64_string: str) -> Image.Image:
     buf = BytesIO(img_data)
     img = Image.open(buf)
     return img
+
+
+def save_thumbnail(src_path: str, dst_path: str, max_side: int, quality: int = 85):
+    """生成长边不超过max_side的JPEG缩略图；JPEG源图用draft在解码阶段降采样"""
+    with Image.open(src_path) as img:
+        width, height = img.size
+        scale = min(1.0, max_side / max(width, height))
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        if img.format == "JPEG":
+            img.draft("RGB", size)
+        img = img.convert("RGB")
+        if img.size != size:
+            img = img.resize(size, Image.Resampling.BILINEAR)
+        img.save(dst_path, "JPEG", quality=quality)
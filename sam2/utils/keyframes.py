@@ -0,0 +1,158 @@
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+import numpy as np
+from PIL import Image
+from utils.cache_utils import LRUByteCache
+
+SIGNATURE_FILE = ".frame_signatures.npz"
+SIGNATURE_SIZE = 32
+# 内存缓存中每帧的估计占用：签名本身加文件名、mtime等字典开销
+_ENTRY_NBYTES = SIGNATURE_SIZE * SIGNATURE_SIZE + 160
+
+
+def frame_signature(path: str, size: int = SIGNATURE_SIZE) -> np.ndarray:
+    """帧签名：缩到size×size的灰度图（JPEG用draft在解码阶段降采样）"""
+    with Image.open(path) as img:
+        if img.format == "JPEG":
+            img.draft("L", (size * 2, size * 2))
+        img = img.convert("L").resize((size, size), Image.Resampling.BILINEAR)
+        return np.asarray(img, dtype=np.uint8).ravel()
+
+
+def change_scores(signatures: np.ndarray) -> np.ndarray:
+    """相邻帧签名的平均绝对差（0-255），第一帧为0"""
+    scores = np.zeros(len(signatures), dtype=np.float32)
+    if len(signatures) > 1:
+        diff = np.abs(np.diff(signatures.astype(np.int16), axis=0))
+        scores[1:] = diff.mean(axis=1)
+    return scores
+
+
+def select_keyframes(
+    candidates: List[int], scores: np.ndarray, count: int, floor: float = 0.1
+) -> List[int]:
+    """在候选帧中选count帧，帧预算按画面变化量分配
+
+    每个候选帧的权重为它与上一候选帧之间的累计变化量，再加上平均权重的floor倍，
+    使静止片段仍有少量采样；按累计权重等分取帧，变化剧烈的区间取帧更密。
+    """
+    if count >= len(candidates):
+        return list(candidates)
+    if count <= 1:
+        return list(candidates[:count])
+
+    cumulative = np.concatenate([[0.0], np.cumsum(scores, dtype=np.float64)])
+    bounds = np.asarray(candidates)
+    weights = np.empty(len(bounds), dtype=np.float64)
+    weights[0] = 0.0
+    weights[1:] = cumulative[bounds[1:] + 1] - cumulative[bounds[:-1] + 1]
+    weights += floor * max(weights.mean(), 1e-6)
+
+    positions = np.cumsum(weights)
+    positions -= positions[0]
+    targets = np.linspace(0, positions[-1], count)
+    picked = np.unique(np.searchsorted(positions, targets, side="left"))
+
+    if len(picked) < count:
+        # 变化区间的候选帧已全部选中（多个目标落在同一帧），剩余预算在其余候选帧中均匀分配
+        rest = np.setdiff1d(np.arange(len(bounds)), picked)
+        need = count - len(picked)
+        extra = rest[np.round(np.linspace(0, len(rest) - 1, need)).astype(int)]
+        picked = np.sort(np.concatenate([picked, extra]))
+
+    return bounds[picked].tolist()
+
+
+class FrameSignatureCache:
+    """按帧目录缓存帧签名
+
+    签名连同文件名、mtime、大小保存在目录下的.frame_signatures.npz中（隐藏文件，
+    不会被当作帧扫描），重复查询时只为新增或修改过的帧重新计算；最近使用的目录
+    按字节预算（max_bytes）以LRU保留在内存中，被淘汰的目录下次从.npz读回。
+    目录不可写时只使用内存缓存。
+    """
+
+    def __init__(self, workers: int = 8, max_bytes: int = 256 * 1024**2):
+        self.workers = max(1, workers)
+        self._memory = LRUByteCache(
+            max_bytes, sizeof=lambda entries: len(entries) * _ENTRY_NBYTES
+        )
+
+    def _load(self, folder: str) -> Dict[str, Tuple[int, int, np.ndarray]]:
+        entries = self._memory.get(folder)
+        if entries is not None:
+            return dict(entries)
+
+        entries = {}
+        try:
+            with np.load(os.path.join(folder, SIGNATURE_FILE)) as data:
+                if data["signatures"].shape[1:] == (SIGNATURE_SIZE * SIGNATURE_SIZE,):
+                    for name, mtime_ns, size, sig in zip(
+                        data["names"], data["mtime_ns"], data["sizes"], data["signatures"]
+                    ):
+                        entries[str(name)] = (int(mtime_ns), int(size), sig)
+        except (OSError, KeyError, ValueError):
+            pass
+        return entries
+
+    def _save(self, folder: str, entries: Dict[str, Tuple[int, int, np.ndarray]]):
+        names = sorted(entries)
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=".sig", suffix=".npz")
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(
+                    f,
+                    names=np.array(names),
+                    mtime_ns=np.array([entries[n][0] for n in names], dtype=np.int64),
+                    sizes=np.array([entries[n][1] for n in names], dtype=np.int64),
+                    signatures=np.stack([entries[n][2] for n in names]),
+                )
+            os.replace(tmp_path, os.path.join(folder, SIGNATURE_FILE))
+        except OSError:
+            pass
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def signatures(self, folder: str, names: List[str]) -> np.ndarray:
+        """返回(len(names), SIGNATURE_SIZE²)签名矩阵，未缓存或已变化的帧并行计算"""
+        folder = os.path.abspath(folder)
+        entries = self._load(folder)
+
+        stats = []
+        for name in names:
+            st = os.stat(os.path.join(folder, name))
+            stats.append((st.st_mtime_ns, st.st_size))
+
+        stale = [
+            i
+            for i, (name, stat) in enumerate(zip(names, stats))
+            if entries.get(name, (None, None))[:2] != stat
+        ]
+        if stale:
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(stale))) as pool:
+                computed = pool.map(
+                    lambda i: frame_signature(os.path.join(folder, names[i])), stale
+                )
+                for i, sig in zip(stale, computed):
+                    entries[names[i]] = (*stats[i], sig)
+            self._save(folder, entries)
+
+        self._memory.put(folder, entries)
+
+        if not names:
+            return np.zeros((0, SIGNATURE_SIZE * SIGNATURE_SIZE), dtype=np.uint8)
+        return np.stack([entries[name][2] for name in names])
+
+    def change_scores(self, folder: str, names: List[str]) -> np.ndarray:
+        """按names顺序返回每帧相对上一帧的变化量"""
+        return change_scores(self.signatures(folder, names))
+
+    def stats(self) -> dict:
+        return self._memory.stats()
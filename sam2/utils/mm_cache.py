@@ -0,0 +1,292 @@
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from threading import Lock
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+from utils.cache_utils import LRUByteCache
+
+VISION_TYPES = ("image", "image_url", "video")
+
+
+def _source_key(source) -> Optional[Tuple]:
+    """视觉输入来源的缓存键：本地文件取(路径, mtime, 大小)，data URI取内容哈希"""
+    if not isinstance(source, str):
+        return None
+    if source.startswith("data:"):
+        return ("data", hashlib.sha1(source.encode("utf-8")).hexdigest())
+
+    path = source[len("file://") :] if source.startswith("file://") else source
+    if not os.path.isabs(path):
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return ("file", path, st.st_mtime_ns, st.st_size)
+
+
+def vision_cache_key(messages: List[Dict], *extra) -> Optional[Tuple]:
+    """由消息中的全部视觉输入（来源 + 缩放等参数）生成缓存键
+
+    存在无法稳定标识的输入（远程URL、内存中的图像）时返回None，表示不缓存。
+    """
+    parts = []
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            continue
+        for item in content:
+            kind = item.get("type")
+            if kind not in VISION_TYPES:
+                continue
+            source_key = _source_key(item.get(kind))
+            if source_key is None:
+                return None
+            options = tuple(
+                sorted((k, repr(v)) for k, v in item.items() if k not in ("type", kind))
+            )
+            parts.append((kind, source_key, options))
+
+    if not parts:
+        return None
+    return (tuple(parts), *extra)
+
+
+def _nbytes(obj) -> int:
+    """估计预处理结果（PIL图像、张量、数组及其容器）的内存占用"""
+    if obj is None:
+        return 0
+    if isinstance(obj, (list, tuple)):
+        return sum(_nbytes(v) for v in obj)
+    if isinstance(obj, dict):
+        return sum(_nbytes(v) for v in obj.values())
+    if hasattr(obj, "nbytes"):
+        return int(obj.nbytes)
+    if hasattr(obj, "element_size") and hasattr(obj, "numel"):
+        return obj.element_size() * obj.numel()
+    if hasattr(obj, "size") and hasattr(obj, "getbands"):
+        width, height = obj.size
+        return width * height * len(obj.getbands())
+    return 64
+
+
+class VisionInputCache:
+    """process_vision_info 结果的LRU缓存
+
+    同一批帧（路径、mtime、缩放参数均相同）上的追问直接复用预处理后的图像/视频输入，
+    跳过解码与缩放；配合vLLM前缀缓存，图像token的prefill也可复用。
+    """
+
+    def __init__(self, max_bytes: int):
+        self._cache = LRUByteCache(max_bytes, sizeof=_nbytes)
+
+    def get_or_process(
+        self, messages: List[Dict], process: Callable[[List[Dict]], Any], *extra
+    ):
+        """返回process(messages)的结果，可缓存时优先从缓存读取"""
+        key = vision_cache_key(messages, *extra)
+        if key is not None:
+            cached = self._cache.get(key)
+            if cached is not None:
+                return cached
+
+        result = process(messages)
+        if key is not None:
+            self._cache.put(key, result)
+        return result
+
+    def stats(self) -> dict:
+        return self._cache.stats()
+
+    def clear(self):
+        self._cache.clear()
+
+
+def _local_path(source) -> Optional[str]:
+    if not isinstance(source, str) or source.startswith(("data:", "http://", "https://")):
+        return None
+    path = source[len("file://") :] if source.startswith("file://") else source
+    return path if os.path.isabs(path) else None
+
+
+class FrameArrayCache:
+    """按内容寻址的帧数组缓存：缩放并按patch对齐后的RGB uint8数组
+
+    键为 (文件内容sha1, 目标宽高)，内存中按字节预算LRU淘汰；配置disk_dir时数组同时
+    以.npy写入磁盘，淘汰或进程重启后以内存映射方式读回，不同进程（服务与脚本）可共享。
+    未命中的帧在线程池中并行解码。
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        disk_dir: Optional[str] = None,
+        workers: int = 8,
+        max_digests: int = 65536,
+    ):
+        self.disk_dir = disk_dir
+        self.workers = max(1, workers)
+        self._memory = LRUByteCache(max_bytes, sizeof=lambda arr: arr.nbytes)
+        # (路径, mtime, 大小) -> 内容sha1 的LRU，避免重复读取文件计算哈希
+        self._digests = OrderedDict()
+        self._max_digests = max(1, max_digests)
+        self._digests_lock = Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @staticmethod
+    def _stat_key(path: str) -> Tuple:
+        st = os.stat(path)
+        return (path, st.st_mtime_ns, st.st_size)
+
+    def _cached_digest(self, stat_key: Tuple) -> Optional[str]:
+        with self._digests_lock:
+            digest = self._digests.get(stat_key)
+            if digest is not None:
+                self._digests.move_to_end(stat_key)
+        return digest
+
+    def _remember_digest(self, stat_key: Tuple, digest: str):
+        with self._digests_lock:
+            self._digests[stat_key] = digest
+            self._digests.move_to_end(stat_key)
+            while len(self._digests) > self._max_digests:
+                self._digests.popitem(last=False)
+
+    def _disk_path(self, key: Tuple) -> str:
+        digest, width, height = key
+        return os.path.join(self.disk_dir, digest[:2], f"{digest}_{width}x{height}.npy")
+
+    def _load(self, key: Tuple) -> Optional[np.ndarray]:
+        arr = self._memory.get(key)
+        if arr is None and self.disk_dir:
+            disk_path = self._disk_path(key)
+            if os.path.exists(disk_path):
+                try:
+                    arr = np.load(disk_path, mmap_mode="r")
+                    self._memory.put(key, arr)
+                except (OSError, ValueError):
+                    arr = None
+        return arr
+
+    def _store(self, key: Tuple, arr: np.ndarray):
+        self._memory.put(key, arr)
+        if not self.disk_dir:
+            return
+        disk_path = self._disk_path(key)
+        if os.path.exists(disk_path):
+            return
+        os.makedirs(os.path.dirname(disk_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(disk_path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, arr)
+            os.replace(tmp_path, disk_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @staticmethod
+    def _decode(source, width: int, height: int) -> np.ndarray:
+        """解码文件路径或文件对象并缩放为(height, width, 3)数组"""
+        with Image.open(source) as img:
+            if img.format == "JPEG":
+                img.draft("RGB", (width, height))
+            # 与qwen_vl_utils.fetch_image一致：RGBA按白底合成，再用默认插值缩放
+            if img.mode == "RGBA":
+                background = Image.new("RGB", img.size, (255, 255, 255))
+                background.paste(img, mask=img.split()[3])
+                img = background
+            else:
+                img = img.convert("RGB")
+            if img.size != (width, height):
+                img = img.resize((width, height))
+            return np.asarray(img)
+
+    def _read_and_decode(self, path: str, stat_key: Tuple, width: int, height: int):
+        """未命中的帧只读取一次文件：同一份字节既用于计算sha1，也用于解码"""
+        with open(path, "rb") as f:
+            data = f.read()
+        digest = hashlib.sha1(data).hexdigest()
+        self._remember_digest(stat_key, digest)
+        key = (digest, width, height)
+        # 内容相同的其他文件可能已缓存
+        arr = self._load(key)
+        if arr is not None:
+            return key, arr, False
+        return key, self._decode(BytesIO(data), width, height), True
+
+    def get_frames(self, paths: List[str], sizes: List[Tuple[int, int]]) -> List[np.ndarray]:
+        """读取一组帧（目标宽高与paths一一对应），未命中的帧并行解码后写入缓存"""
+        stat_keys = [self._stat_key(path) for path in paths]
+        frames = [None] * len(paths)
+        for i, (stat_key, (w, h)) in enumerate(zip(stat_keys, sizes)):
+            digest = self._cached_digest(stat_key)
+            if digest is not None:
+                frames[i] = self._load((digest, w, h))
+
+        misses = [i for i, arr in enumerate(frames) if arr is None]
+        if misses:
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(misses))) as pool:
+                decoded = pool.map(
+                    lambda i: self._read_and_decode(paths[i], stat_keys[i], *sizes[i]),
+                    misses,
+                )
+                for i, (key, arr, fresh) in zip(misses, decoded):
+                    if fresh:
+                        self._store(key, arr)
+                    frames[i] = arr
+        return frames
+
+    def materialize(self, messages: List[Dict], patch_factor: int) -> List[Dict]:
+        """把消息中带resized_width/height的本地图像替换为缓存帧（PIL图像）
+
+        目标尺寸与qwen_vl_utils相同（smart_resize按patch_factor对齐），
+        因此process_vision_info对替换后的图像不再做实质缩放。
+        """
+        from qwen_vl_utils.vision_process import smart_resize
+
+        items, paths, sizes = [], [], []
+        for message in messages:
+            content = message.get("content")
+            if isinstance(content, str):
+                continue
+            for item in content:
+                if item.get("type") != "image" or "resized_width" not in item:
+                    continue
+                path = _local_path(item.get("image"))
+                if path is None or "resized_height" not in item:
+                    continue
+                height, width = smart_resize(
+                    item["resized_height"], item["resized_width"], factor=patch_factor
+                )
+                items.append(item)
+                paths.append(path)
+                sizes.append((width, height))
+
+        if not items:
+            return messages
+
+        frames = dict(zip(map(id, items), self.get_frames(paths, sizes)))
+        materialized = []
+        for message in messages:
+            content = message.get("content")
+            if isinstance(content, str):
+                materialized.append(message)
+                continue
+            new_content = []
+            for item in content:
+                if id(item) in frames:
+                    item = {**item, "image": Image.fromarray(np.asarray(frames[id(item)]))}
+                new_content.append(item)
+            materialized.append({**message, "content": new_content})
+        return materialized
+
+    def stats(self) -> dict:
+        return {**self._memory.stats(), "disk_dir": self.disk_dir}
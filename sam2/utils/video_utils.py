@@ -1,20 +1,167 @@
 import os
+import shutil
 import subprocess
+import tempfile
+from typing import Callable, List, Optional, Tuple
 
+import cv2
+from PIL import Image
 
-def extract_frames_from_video(video_path: str):
-    """使用FFmpeg从视频中提取帧并保存为JPEG文件"""
-    video_dir = os.path.splitext(video_path)[0] + "_mp4"
-    if not os.path.exists(video_dir):
-        os.makedirs(video_dir)
+VIDEO_EXTENSIONS = (".mp4", ".mkv", ".avi", ".mov", ".webm", ".flv", ".ts")
 
-    cmd = f"ffmpeg -i {video_path} -q:v 2 -start_number 0 {video_dir}/%05d.jpg"
-    subprocess.run(
-        cmd,
-        check=True,
-        shell=True,
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL,
+
+def build_frame_filter(
+    fps: Optional[float] = None,
+    width: Optional[int] = None,
+    height: Optional[int] = None,
+) -> Optional[str]:
+    """构造 -vf 滤镜：先按fps抽帧再缩放，只给出宽或高时按比例缩放（取偶数）"""
+    filters = []
+    if fps:
+        filters.append(f"fps={fps}")
+    if width or height:
+        filters.append(f"scale={width or -2}:{height or -2}")
+    return ",".join(filters) or None
+
+
+def _list_jpgs(folder: str) -> List[str]:
+    return [
+        entry.name
+        for entry in os.scandir(folder)
+        if entry.is_file() and entry.name.lower().endswith(".jpg")
+    ]
+
+
+def extract_frames_from_video(
+    video_path: str,
+    output_dir: Optional[str] = None,
+    fps: Optional[float] = None,
+    width: Optional[int] = None,
+    height: Optional[int] = None,
+    quality: int = 2,
+    on_progress: Optional[Callable[[int], None]] = None,
+    overwrite: bool = False,
+):
+    """使用FFmpeg从视频中提取帧并保存为JPEG文件（%05d.jpg，从00000开始）
+
+    fps/width/height 在解码阶段直接通过 -vf fps=,scale= 生效，不再先落盘全部原始帧。
+    on_progress(已输出帧数) 按ffmpeg的 -progress 输出周期回调，最后一次回调即总帧数。
+    帧先写入同级临时目录，ffmpeg成功后才替换目标目录中的.jpg（旧帧整体删除，不残留
+    高序号帧）；失败时目标目录保持不变。目标目录已有.jpg且overwrite为False时拒绝执行。
+    """
+    video_dir = os.path.abspath(output_dir or os.path.splitext(video_path)[0] + "_mp4")
+    if os.path.isdir(video_dir) and not overwrite and _list_jpgs(video_dir):
+        raise FileExistsError(f"输出目录已有帧文件，如需覆盖请设置overwrite: {video_dir}")
+    os.makedirs(video_dir, exist_ok=True)
+
+    tmp_dir = tempfile.mkdtemp(
+        prefix=f".{os.path.basename(video_dir)}.tmp", dir=os.path.dirname(video_dir)
     )
+    try:
+        cmd = ["ffmpeg", "-nostdin", "-y", "-i", video_path]
+        vf = build_frame_filter(fps, width, height)
+        if vf:
+            cmd += ["-vf", vf]
+        cmd += [
+            "-q:v", str(quality),
+            "-start_number", "0",
+            "-progress", "pipe:1",
+            "-nostats",
+            os.path.join(tmp_dir, "%05d.jpg"),
+        ]
+
+        # stderr写入临时文件（不与stdout的进度管道互相阻塞），失败时附在异常中
+        with tempfile.TemporaryFile() as stderr_file:
+            proc = subprocess.Popen(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=stderr_file,
+                text=True,
+            )
+            for line in proc.stdout:
+                key, _, value = line.strip().partition("=")
+                if key == "frame" and on_progress is not None and value.isdigit():
+                    on_progress(int(value))
+            proc.stdout.close()
+            returncode = proc.wait()
+            if returncode != 0:
+                stderr_file.seek(0)
+                stderr = stderr_file.read()[-4096:].decode("utf-8", "replace")
+                raise subprocess.CalledProcessError(returncode, cmd, stderr=stderr)
+
+        new_frames = _list_jpgs(tmp_dir)
+        for name in _list_jpgs(video_dir):
+            os.remove(os.path.join(video_dir, name))
+        for name in new_frames:
+            os.replace(os.path.join(tmp_dir, name), os.path.join(video_dir, name))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
 
     return video_dir
+
+
+def is_video_file(path: str) -> bool:
+    """按扩展名判断是否为视频文件"""
+    return os.path.isfile(path) and path.lower().endswith(VIDEO_EXTENSIONS)
+
+
+def probe_video(video_path: str) -> Tuple[float, int, int, int]:
+    """读取视频的帧率、总帧数与帧宽高"""
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise ValueError(f"无法打开视频: {video_path}")
+    try:
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    finally:
+        cap.release()
+    if fps <= 0 or frame_count <= 0:
+        raise ValueError(f"无法获取视频帧率或帧数: {video_path}")
+    return fps, frame_count, width, height
+
+
+def read_video_frames(
+    video_path: str,
+    frame_indices: List[int],
+    width: Optional[int] = None,
+    height: Optional[int] = None,
+    max_forward: int = 64,
+) -> List[Image.Image]:
+    """只解码指定帧（升序），缩放后返回RGB PIL图像列表
+
+    与下一目标帧相距不超过max_forward帧时顺序grab跳过，否则直接seek
+    （解码器从最近的关键帧解码到目标帧）。读取失败的帧用最近成功的一帧代替。
+    """
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise ValueError(f"无法打开视频: {video_path}")
+
+    images = []
+    position = 0
+    last_frame = None
+    try:
+        for frame_idx in frame_indices:
+            if frame_idx < position or frame_idx - position > max_forward:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
+                position = frame_idx
+            while position < frame_idx and cap.grab():
+                position += 1
+
+            ret, frame = cap.read()
+            if ret:
+                position += 1
+                last_frame = frame
+            elif last_frame is None:
+                raise ValueError(f"读取视频帧失败: {video_path} 第{frame_idx}帧")
+            else:
+                frame = last_frame
+
+            if width and height:
+                frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+            images.append(Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)))
+    finally:
+        cap.release()
+
+    return images
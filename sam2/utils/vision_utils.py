@@ -1,8 +1,9 @@
 import ast
 import json
+import math
 import re
 from io import BytesIO
-from typing import Any, Dict, List
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
 
 import numpy as np
 import requests
@@ -52,6 +53,68 @@ def parse_json_from_response(response: str) -> List[Dict[str, Any]]:
         return ast.literal_eval(truncated_text)
 
 
+class IncrementalJSONArrayParser:
+    """增量解析流式输出的JSON检测数组，每个顶层对象在其右花括号出现时立即返回
+
+    对象之外的文本（markdown代码块标记、说明文字等）会被忽略。
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, delta: str) -> List[Dict[str, Any]]:
+        """输入增量文本，返回本次新闭合的对象列表"""
+        self._buffer += delta
+        items = []
+
+        while self._pos < len(self._buffer):
+            ch = self._buffer[self._pos]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == "{":
+                if self._depth == 0:
+                    # 丢弃已消费的文本，缓冲区只保留当前对象
+                    self._buffer = self._buffer[self._pos :]
+                    self._pos = 0
+                self._depth += 1
+            elif self._depth > 0 and ch == '"':
+                self._in_string = True
+            elif self._depth > 0 and ch == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    obj = _loads_object(self._buffer[: self._pos + 1])
+                    if obj is not None:
+                        items.append(obj)
+            self._pos += 1
+
+        if self._depth == 0:
+            self._buffer = ""
+            self._pos = 0
+
+        return items
+
+
+def _loads_object(text: str):
+    """解析单个JSON对象，兼容Python字面量写法，失败返回None"""
+    try:
+        obj = json.loads(text)
+    except ValueError:
+        try:
+            obj = ast.literal_eval(text)
+        except (ValueError, SyntaxError):
+            return None
+    return obj if isinstance(obj, dict) else None
+
+
 def draw_bounding_boxes(
     image: Image.Image, results: List[Dict], font_path: str = None
 ) -> Image.Image:
@@ -184,3 +247,104 @@ def load_image_from_source(image_source: str) -> Image.Image:
         return Image.open(image_source[7:])
     else:
         return Image.open(image_source)
+
+
+def detection_time(result: Dict) -> Optional[float]:
+    """读取检测结果的时间戳（秒），无法解析时返回None"""
+    try:
+        return float(result.get("time"))
+    except (TypeError, ValueError):
+        return None
+
+
+def merge_window_detections(
+    window_results: Sequence[List[Dict]], window_ranges: Sequence[Tuple[float, float]]
+) -> List[Dict]:
+    """合并重叠时间窗口的检测结果，按时间排序
+
+    同一时间戳可能出现在相邻窗口的重叠区间，此时只保留窗口中心离该时间最近的窗口
+    给出的结果；时间戳不落在任何窗口内（或无法解析）的结果保留其来源窗口的输出。
+    """
+    centers = [(start + end) / 2 for start, end in window_ranges]
+    merged = []
+    for w, results in enumerate(window_results):
+        for result in results:
+            if not isinstance(result, dict):
+                continue
+            t = detection_time(result)
+            if t is not None:
+                owners = [
+                    i
+                    for i, (start, end) in enumerate(window_ranges)
+                    if start <= t <= end
+                ]
+                if owners and min(owners, key=lambda i: abs(t - centers[i])) != w:
+                    continue
+            merged.append(result)
+
+    merged.sort(key=lambda r: (detection_time(r) is None, detection_time(r) or 0.0))
+    return merged
+
+
+def create_image_grid(images: List[Image.Image], num_columns: int = 4) -> Optional[Image.Image]:
+    """把图像按行列拼接成网格（以第一张图像的尺寸为格子大小）"""
+    if not images:
+        return None
+
+    num_rows = math.ceil(len(images) / num_columns)
+    img_width, img_height = images[0].size
+    grid_image = Image.new(
+        "RGB", (num_columns * img_width, num_rows * img_height), color="white"
+    )
+
+    for idx, image in enumerate(images):
+        row_idx, col_idx = divmod(idx, num_columns)
+        if image.size != (img_width, img_height):
+            image = image.resize((img_width, img_height))
+        grid_image.paste(image, (col_idx * img_width, row_idx * img_height))
+
+    return grid_image
+
+
+def draw_timestamped_detection(image: Image.Image, result: Dict) -> Image.Image:
+    """在图像上绘制单个检测框（0-1000归一化坐标）和时间戳"""
+    width, height = image.size
+    draw = ImageDraw.Draw(image)
+
+    bbox = result.get("bbox_2d", [])
+    if len(bbox) == 4:
+        draw.rectangle(
+            normalize_to_absolute_coords(bbox, width, height), outline="red", width=4
+        )
+    draw.text(
+        (10, 10),
+        f"Time: {result.get('time')}s",
+        fill="red",
+        stroke_width=2,
+        stroke_fill="white",
+    )
+    return image
+
+
+def build_detection_grids(
+    results: List[Dict],
+    frame_for_time: Callable[[float], Optional[Image.Image]],
+    grid_size: int = 16,
+    columns: int = 4,
+) -> List[Image.Image]:
+    """每grid_size个检测结果生成一张网格图，frame_for_time(时间戳)返回对应帧"""
+    grid_images = []
+    for start in range(0, len(results), grid_size):
+        tiles = []
+        for result in results[start : start + grid_size]:
+            t = detection_time(result)
+            frame = frame_for_time(t) if t is not None else None
+            if frame is None:
+                continue
+            tiles.append(draw_timestamped_detection(frame.convert("RGB"), result))
+
+        grid_image = create_image_grid(tiles, num_columns=columns)
+        if grid_image is not None:
+            grid_images.append(grid_image)
+
+    return grid_images
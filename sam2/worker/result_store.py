@@ -0,0 +1,174 @@
+import json
+import sqlite3
+import time
+from collections import OrderedDict
+from threading import RLock
+from typing import Optional
+
+from loguru import logger
+from utils.cache_utils import LRUByteCache
+
+TERMINAL_STATUSES = ("done", "error")
+
+
+def estimate_nbytes(obj) -> int:
+    """粗略估计结果对象的内存占用（以字符串/字节长度为主）"""
+    if isinstance(obj, (str, bytes)):
+        return len(obj)
+    if isinstance(obj, dict):
+        return sum(estimate_nbytes(k) + estimate_nbytes(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return sum(estimate_nbytes(v) for v in obj)
+    return 8
+
+
+class TaskResultStore:
+    """任务状态与结果存储
+
+    - 进行中的任务只保存状态与帧进度；
+    - 完成后的结果按字节预算LRU保存在内存中，超出预算时溢出到SQLite（若配置），否则丢弃，
+      任务改为error状态并保留一条"result evicted"占位结果直到ttl到期；
+    - 完成超过ttl秒的任务被整体淘汰，不论是否被取走。
+    """
+
+    def __init__(
+        self, max_bytes: int, ttl: float, spill_path: Optional[str] = None
+    ):
+        self.ttl = ttl
+        self._tasks = {}
+        self._finished = OrderedDict()
+        self._lock = RLock()
+        self._results = LRUByteCache(
+            max_bytes, sizeof=estimate_nbytes, on_evict=self._on_result_evicted
+        )
+        self._db = None
+        if spill_path:
+            self._db = sqlite3.connect(spill_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results (task_id TEXT PRIMARY KEY, result TEXT)"
+            )
+            self._db.execute("DELETE FROM results")
+            self._db.commit()
+        self.spilled = 0
+        self.dropped = 0
+        self.expired = 0
+
+    def __contains__(self, task_id) -> bool:
+        with self._lock:
+            self._expire()
+            return task_id in self._tasks
+
+    def create(self, task_id: str):
+        with self._lock:
+            self._expire()
+            self._tasks[task_id] = {
+                "status": "queued",
+                "frames": {},
+                "created": time.time(),
+            }
+
+    def set_status(self, task_id: str, status: str):
+        with self._lock:
+            self._tasks[task_id]["status"] = status
+
+    def mark_frame(self, task_id: str, frame_idx, state: str = "done") -> int:
+        """记录单帧进度，返回已记录帧数"""
+        with self._lock:
+            frames = self._tasks[task_id]["frames"]
+            frames[frame_idx] = state
+            return len(frames)
+
+    def finish(self, task_id: str, status: str, result):
+        """写入终态与结果"""
+        with self._lock:
+            task = self._tasks[task_id]
+            task["status"] = status
+            self._finished[task_id] = time.time()
+            if not self._results.put(task_id, result):
+                self._on_result_evicted(task_id, result)
+
+    def get(self, task_id: str) -> dict:
+        """返回任务信息 {status, result, frames}；结果不做深拷贝，调用方不应修改"""
+        with self._lock:
+            self._expire()
+            task = self._tasks[task_id]
+            info = {"status": task["status"], "result": None, "frames": task["frames"]}
+            if task["status"] in TERMINAL_STATUSES:
+                info["result"] = self._load_result(task_id)
+            return info
+
+    def pop(self, task_id: str) -> dict:
+        """取出并移除任务"""
+        with self._lock:
+            info = self.get(task_id)
+            self._remove(task_id)
+            return info
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._expire()
+            return {
+                "tasks": len(self._tasks),
+                "finished": len(self._finished),
+                "ttl": self.ttl,
+                "memory": self._results.stats(),
+                "spilled": self.spilled,
+                "spilled_entries": self._count_spilled(),
+                "dropped": self.dropped,
+                "expired": self.expired,
+            }
+
+    def _load_result(self, task_id: str):
+        tombstone = self._tasks[task_id].get("tombstone")
+        if tombstone is not None:
+            return tombstone
+        result = self._results.get(task_id)
+        if result is None and self._db is not None:
+            row = self._db.execute(
+                "SELECT result FROM results WHERE task_id = ?", (task_id,)
+            ).fetchone()
+            if row is not None:
+                result = json.loads(row[0])
+        return result
+
+    def _on_result_evicted(self, task_id: str, result):
+        """内存预算不足时的淘汰回调：溢出到磁盘或整体丢弃任务"""
+        with self._lock:
+            if task_id not in self._tasks:
+                return
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO results (task_id, result) VALUES (?, ?)",
+                    (task_id, json.dumps(result, ensure_ascii=False)),
+                )
+                self._db.commit()
+                self.spilled += 1
+            else:
+                # 保留占位记录直到ttl到期，使调用方能区分"结果已被淘汰"与"任务不存在"
+                logger.warning(f"Task {task_id} result dropped: store over budget")
+                task = self._tasks[task_id]
+                task["status"] = "error"
+                task["tombstone"] = {"error": "result evicted: store over budget"}
+                self.dropped += 1
+
+    def _remove(self, task_id: str):
+        self._tasks.pop(task_id, None)
+        self._finished.pop(task_id, None)
+        self._results.pop(task_id)
+        if self._db is not None:
+            self._db.execute("DELETE FROM results WHERE task_id = ?", (task_id,))
+            self._db.commit()
+
+    def _expire(self):
+        deadline = time.time() - self.ttl
+        while self._finished:
+            task_id, finished_at = next(iter(self._finished.items()))
+            if finished_at > deadline:
+                break
+            self._remove(task_id)
+            self.expired += 1
+
+    def _count_spilled(self) -> int:
+        if self._db is None:
+            return 0
+        return self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
@@ -1,87 +1,326 @@
+import asyncio
+import time
 import uuid
-from copy import deepcopy
-from queue import Queue
-from threading import Thread
+from collections import defaultdict, deque
+from queue import Empty, Full, Queue
+from threading import Lock, Thread
 
 from config.settings import settings
 from loguru import logger
-from models.schemas import (SegmentBatchRequest, SegmentRequest,
-                            VisionAnalysisRequest)
+from models.schemas import (IngestVideoRequest, PropagateRequest,
+                            SegmentBatchRequest, SegmentRequest,
+                            VideoAnalysisRequest, VisionAnalysisRequest)
+from services.file_service import ingest_video
 from services.segmentation_service import segmentation_service
 from services.vision_service import vision_service
+from worker.result_store import TERMINAL_STATUSES, TaskResultStore
 
-# 全局任务状态和队列
-TASK_STATUS = {}
-TASK_QUEUE = Queue(maxsize=settings.task_queue_maxsize)
+# 全局任务状态存储；每个模型一个独立任务池（队列 + worker），互不阻塞
+TASK_STORE = TaskResultStore(
+    max_bytes=settings.task_result_max_bytes,
+    ttl=settings.task_result_ttl,
+    spill_path=settings.task_result_spill_path,
+)
+TASK_QUEUES = {
+    "segmentation": Queue(maxsize=settings.segmentation_queue_maxsize),
+    "vision": Queue(maxsize=settings.vision_queue_maxsize),
+    "propagation": Queue(maxsize=settings.propagation_queue_maxsize),
+    "ingest": Queue(maxsize=settings.ingest_queue_maxsize),
+}
+POOL_WORKERS = {
+    "segmentation": settings.segmentation_workers,
+    "vision": settings.vision_workers,
+    "propagation": settings.propagation_workers,
+    "ingest": settings.ingest_workers,
+}
 
+# 任务事件订阅者: task_id -> [(事件循环, asyncio.Queue)]
+_SUBSCRIBERS = defaultdict(list)
+_SUBSCRIBERS_LOCK = Lock()
 
-def worker_loop():
-    """工作线程循环，顺序执行队列任务"""
+
+def _route(req) -> str:
+    """按请求类型选择任务池"""
+    if isinstance(req, (SegmentRequest, SegmentBatchRequest)):
+        return "segmentation"
+    if isinstance(req, (VisionAnalysisRequest, VideoAnalysisRequest)):
+        return "vision"
+    if isinstance(req, PropagateRequest):
+        return "propagation"
+    if isinstance(req, IngestVideoRequest):
+        return "ingest"
+    raise ValueError(f"Unknown request type: {type(req)}")
+
+
+def _publish(task_id, event: dict):
+    """把任务事件推送给所有订阅者（可在worker线程中调用）"""
+    with _SUBSCRIBERS_LOCK:
+        subscribers = list(_SUBSCRIBERS.get(task_id, ()))
+    for loop, queue in subscribers:
+        loop.call_soon_threadsafe(queue.put_nowait, event)
+
+
+def _set_status(task_id, status: str):
+    """更新任务状态并推送事件"""
+    TASK_STORE.set_status(task_id, status)
+    _publish(task_id, {"event": status, "task_id": task_id})
+
+
+def _mark_frame_done(task_id, frame_idx, total: int = None):
+    """标记单帧完成并推送进度事件"""
+    done = TASK_STORE.mark_frame(task_id, frame_idx)
+    _publish(
+        task_id,
+        {
+            "event": "frame",
+            "task_id": task_id,
+            "frame": frame_idx,
+            "done": done,
+            "total": total,
+        },
+    )
+
+
+def _publish_progress(task_id, done: int):
+    """推送不按帧记录的进度事件（如抽帧数）"""
+    _publish(task_id, {"event": "progress", "task_id": task_id, "done": done})
+
+
+def _run_task(task_id, req):
+    """执行单个分割/传播/视频入库/视频分析任务"""
+    if isinstance(req, SegmentRequest):
+        result = segmentation_service.segment_image(req)
+        _mark_frame_done(task_id, req.frame_idx, total=1)
+    elif isinstance(req, SegmentBatchRequest):
+        total = len(req.frame_indices)
+        result = segmentation_service.segment_images(
+            req, on_frame=lambda idx: _mark_frame_done(task_id, idx, total)
+        )
+    elif isinstance(req, PropagateRequest):
+        result = segmentation_service.propagate(
+            req, on_frame=lambda idx: _mark_frame_done(task_id, idx)
+        )
+    elif isinstance(req, IngestVideoRequest):
+        result = ingest_video(
+            req, on_progress=lambda done: _publish_progress(task_id, done)
+        )
+    elif isinstance(req, VideoAnalysisRequest):
+        result = vision_service.analyze_video(req)
+    else:
+        raise ValueError(f"Unknown request type: {type(req)}")
+    return result
+
+
+def _finish_task(task_id, response_queue, result=None, error=None):
+    """写回任务结果，通知等待方并推送最终事件"""
+    frames = list(TASK_STORE.get(task_id)["frames"].keys())
+    if error is None:
+        status = "done"
+        response_queue.put(("ok", result))
+    else:
+        status, result = "error", str(error)
+        response_queue.put(("error", result))
+        logger.error(f"Task {task_id} failed: {result}")
+    TASK_STORE.finish(task_id, status, result)
+    _publish(
+        task_id,
+        {"event": status, "task_id": task_id, "frames": frames, "result": result},
+    )
+
+
+def _snapshot_event(task_id) -> dict:
+    """当前任务状态的事件快照，终态时附带结果"""
+    task_info = TASK_STORE.get(task_id)
+    event = {
+        "event": task_info["status"],
+        "task_id": task_id,
+        "frames": list(task_info["frames"].keys()),
+    }
+    if task_info["status"] in TERMINAL_STATUSES:
+        event["result"] = task_info["result"]
+    return event
+
+
+def _collect_vision_batch(task_queue: Queue, first_task, pending: deque):
+    """在等待窗口内从队列中收集视觉分析任务，其余任务放入pending稍后执行"""
+    batch = [first_task]
+    deadline = time.monotonic() + settings.llm_batch_wait_ms / 1000
+
+    while len(batch) < settings.llm_batch_size:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            task = task_queue.get(timeout=remaining)
+        except Empty:
+            break
+
+        if task is not None and isinstance(task[1], VisionAnalysisRequest):
+            batch.append(task)
+        else:
+            pending.append(task)
+            if task is None:
+                break
+
+    return batch
+
+
+def _process_vision_batch(task_queue: Queue, batch):
+    """一次llm.generate处理一批视觉分析任务，并把结果分别写回各自任务"""
+    task_ids = [task_id for task_id, _, _ in batch]
+    logger.info(f"Processing vision batch: {task_ids}")
+    for task_id in task_ids:
+        _set_status(task_id, "processing")
+
+    def on_detection(i, detection, annotated_image):
+        task_id = task_ids[i]
+        event = {"event": "detection", "task_id": task_id, "detection": detection}
+        if annotated_image is not None:
+            event["annotated_image"] = annotated_image
+        _publish(task_id, event)
+
+    start = time.perf_counter()
+    try:
+        outcomes = vision_service.analyze_images(
+            [req for _, req, _ in batch], on_detection=on_detection
+        )
+    except Exception as e:
+        outcomes = [e] * len(batch)
+    latency = time.perf_counter() - start
+    logger.info(f"Vision batch done: size={len(batch)}, latency={latency:.2f}s")
+
+    for (task_id, _, response_queue), outcome in zip(batch, outcomes):
+        if isinstance(outcome, Exception):
+            _finish_task(task_id, response_queue, error=outcome)
+        else:
+            _finish_task(task_id, response_queue, result=outcome)
+        task_queue.task_done()
+
+
+def worker_loop(pool: str = "segmentation"):
+    """任务池工作线程循环：分割任务顺序执行，视觉分析任务按批次合并推理"""
+    task_queue = TASK_QUEUES[pool]
+    pending = deque()
     while True:
         try:
-            task = TASK_QUEUE.get()
+            task = pending.popleft() if pending else task_queue.get()
             if task is None:
                 break
             task_id, req, response_queue = task
+
+            if isinstance(req, VisionAnalysisRequest):
+                batch = _collect_vision_batch(task_queue, task, pending)
+                _process_vision_batch(task_queue, batch)
+                continue
+
             logger.info(f"Processing task: {task_id}")
-            TASK_STATUS[task_id]["status"] = "processing"
+            _set_status(task_id, "processing")
 
             try:
-                if isinstance(req, SegmentRequest):
-                    result = segmentation_service.segment_image(req)
-                    TASK_STATUS[task_id]["frames"][req.frame_idx] = "done"
-                elif isinstance(req, SegmentBatchRequest):
-                    result = segmentation_service.segment_images(req)
-                    for idx, img_b64 in result.items():
-                        TASK_STATUS[task_id]["frames"][idx] = "done"
-                elif isinstance(req, VisionAnalysisRequest):
-                    result = vision_service.analyze_image(req)
-                else:
-                    raise ValueError(f"Unknown request type: {type(req)}")
-
-                TASK_STATUS[task_id]["result"] = result
-                TASK_STATUS[task_id]["status"] = "done"
+                result = _run_task(task_id, req)
                 logger.info(f"Processing task: done")
-                response_queue.put(("ok", result))
-
+                _finish_task(task_id, response_queue, result=result)
             except Exception as e:
-                TASK_STATUS[task_id]["status"] = "error"
-                TASK_STATUS[task_id]["result"] = str(e)
-                response_queue.put(("error", str(e)))
-                logger.error(f"Task {task_id} failed: {str(e)}")
+                _finish_task(task_id, response_queue, error=e)
             finally:
-                TASK_QUEUE.task_done()
+                task_queue.task_done()
         except Exception as e:
             logger.error(f"[Worker Error] {e}")
 
 
+def start_workers():
+    """为每个任务池启动对应数量的worker线程"""
+    for pool, num_workers in POOL_WORKERS.items():
+        for i in range(num_workers):
+            Thread(
+                target=worker_loop, args=(pool,), name=f"{pool}-worker-{i}", daemon=True
+            ).start()
+        logger.info(f"Started {num_workers} worker(s) for pool: {pool}")
+
+
+def stop_workers():
+    """向每个worker发送退出信号"""
+    for pool, num_workers in POOL_WORKERS.items():
+        for _ in range(num_workers):
+            try:
+                TASK_QUEUES[pool].put_nowait(None)
+            except Full:
+                logger.warning(f"Queue '{pool}' is full, worker exits with process")
+                break
+
+
 def enqueue_task(req):
-    """将任务放入队列并立即返回task_id"""
-    if TASK_QUEUE.full():
+    """将任务放入对应模型的任务池并立即返回task_id"""
+    pool = _route(req)
+    task_queue = TASK_QUEUES[pool]
+    if task_queue.full():
         from fastapi import HTTPException
 
-        raise HTTPException(status_code=429, detail="Queue is full, try again later.")
+        raise HTTPException(
+            status_code=429, detail=f"Queue '{pool}' is full, try again later."
+        )
 
     task_id = str(uuid.uuid4())
-    TASK_STATUS[task_id] = {"status": "queued", "result": None, "frames": {}}
+    TASK_STORE.create(task_id)
 
     response_queue = Queue()
-    TASK_QUEUE.put((task_id, req, response_queue))
+    task_queue.put((task_id, req, response_queue))
 
     return {"status": "queued", "task_id": task_id}
 
 
 def get_task_status(task_id: str):
-    """获取任务状态"""
-    if task_id not in TASK_STATUS:
+    """获取任务状态；终态任务返回结果后即从存储中移除"""
+    if task_id not in TASK_STORE:
         from fastapi import HTTPException
 
         raise HTTPException(status_code=404, detail="Task ID not found")
 
-    task_info = TASK_STATUS[task_id]
-    if task_info["status"] in ["done", "error"]:
-        r_info = deepcopy(task_info)
-        TASK_STATUS.pop(task_id)
-        return r_info
+    task_info = TASK_STORE.get(task_id)
+    if task_info["status"] in TERMINAL_STATUSES:
+        return TASK_STORE.pop(task_id)
 
     return {"status": task_info["status"], "task_id": task_id}
+
+
+def get_store_stats():
+    """任务存储的大小与淘汰统计"""
+    return TASK_STORE.stats()
+
+
+async def stream_task_events(task_id: str, heartbeat: float = 15.0):
+    """异步产生任务事件：先发送当前状态快照，再实时推送后续事件直到任务结束
+
+    超过heartbeat秒无事件时产生None，供调用方发送保活消息。
+    """
+    if task_id not in TASK_STORE:
+        from fastapi import HTTPException
+
+        raise HTTPException(status_code=404, detail="Task ID not found")
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    subscriber = (loop, queue)
+    with _SUBSCRIBERS_LOCK:
+        _SUBSCRIBERS[task_id].append(subscriber)
+        snapshot = _snapshot_event(task_id)
+
+    finished = False
+    try:
+        event = snapshot
+        while True:
+            yield event
+            if event is not None and event["event"] in TERMINAL_STATUSES:
+                finished = True
+                break
+            try:
+                event = await asyncio.wait_for(queue.get(), timeout=heartbeat)
+            except asyncio.TimeoutError:
+                event = None
+    finally:
+        with _SUBSCRIBERS_LOCK:
+            _SUBSCRIBERS[task_id].remove(subscriber)
+            if not _SUBSCRIBERS[task_id]:
+                _SUBSCRIBERS.pop(task_id)
+        if finished and task_id in TASK_STORE:
+            TASK_STORE.pop(task_id)
@@ -1,9 +1,12 @@
 import os
 import re
 import argparse
-from typing import List, Tuple
+from multiprocessing import Pool
+from typing import Callable, List, Tuple
 from PIL import Image  # 用于图像分辨率调整
 
+from frame_manifest import FrameManifest, atomic_output
+
 
 def get_sorted_frames(input_dir: str) -> List[Tuple[int, str]]:
     """读取输入目录中按{05d}.jpg命名的帧文件，按序号排序"""
@@ -58,30 +61,72 @@ def select_uniform_frames(part_frames: List[Tuple[int, str]], m: int) -> List[Tu
     return [part_frames[idx] for idx in selected_indices]
 
 
-def resize_and_save(orig_path: str, new_path: str, width: int = None, height: int = None) -> bool:
+def resize_and_save(orig_path: str, new_path: str, width: int = None, height: int = None,
+                    draft: bool = True) -> bool:
     """
     读取原图，调整分辨率（可选）并保存
     :param orig_path: 原始图像路径
     :param new_path: 新图像保存路径
     :param width: 目标宽度（像素），为None则不调整
     :param height: 目标高度（像素），为None则不调整
+    :param draft: 目标远小于原图时，让JPEG解码器直接在DCT域按1/2、1/4、1/8缩小
     :return: 成功返回True，失败返回False
     """
     try:
         with Image.open(orig_path) as img:
             # 调整分辨率（如果指定了宽高）
             if width is not None and height is not None:
+                if draft and img.format == "JPEG":
+                    # draft只会选择不小于目标尺寸的缩放比例，随后仍由Lanczos缩放到精确尺寸
+                    img.draft("RGB", (width, height))
                 # 使用Lanczos滤镜进行高质量缩放
                 img = img.resize((width, height), Image.Resampling.LANCZOS)
             
-            # 保存为JPG（保持高质量）
-            img.save(new_path, "JPEG", quality=95, optimize=True)
+            # 保存为JPG（保持高质量），先写临时文件再原子替换，避免中断留下半截文件
+            with atomic_output(new_path) as tmp_path:
+                img.save(tmp_path, "JPEG", quality=95, optimize=True)
         return True
     except Exception as e:
         print(f"  处理失败{os.path.basename(orig_path)}：{str(e)}")
         return False
 
 
+def _resize_job(job: Tuple[str, str, int, int, bool]) -> bool:
+    """进程池任务入口"""
+    return resize_and_save(*job)
+
+
+def run_jobs(jobs: List[Tuple[str, str, int, int, bool]], workers: int = 1, chunksize: int = None,
+             on_result: Callable[[Tuple, bool], None] = None) -> int:
+    """执行所有缩放任务，按提交顺序汇报进度（并回调on_result(job, ok)），返回成功数"""
+    total = len(jobs)
+    report_every = max(1, total // 20)
+    succeeded = 0
+
+    if workers <= 1:
+        results = map(_resize_job, jobs)
+        pool = None
+    else:
+        if chunksize is None:
+            chunksize = max(1, total // (workers * 8))
+        pool = Pool(processes=workers)
+        results = pool.imap(_resize_job, jobs, chunksize=chunksize)
+
+    try:
+        for done, (job, ok) in enumerate(zip(jobs, results), start=1):
+            succeeded += int(ok)
+            if on_result is not None:
+                on_result(job, ok)
+            if done % report_every == 0 or done == total:
+                print(f"  进度：{done}/{total}（成功{succeeded}，失败{done - succeeded}）")
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return succeeded
+
+
 def main():
     # 解析命令行参数
     parser = argparse.ArgumentParser(description="将有序帧文件分割为K部分，每部分保留m帧，并支持调整分辨率")
@@ -91,6 +136,11 @@ def main():
     parser.add_argument("--m", type=int, required=True, help="每部分保留的帧数（正整数）")
     parser.add_argument("--width", type=int, help="目标宽度（像素），不指定则保持原分辨率")
     parser.add_argument("--height", type=int, help="目标高度（像素），不指定则保持原分辨率")
+    parser.add_argument("--workers", type=int, default=1, help="并行进程数（默认1）")
+    parser.add_argument("--chunksize", type=int, help="每个进程一次领取的帧数（默认自动）")
+    parser.add_argument("--no-draft", action="store_true", help="禁用JPEG draft降采样解码")
+    parser.add_argument("--force", action="store_true", help="忽略清单，全部重新处理")
+    parser.add_argument("--hash", action="store_true", help="清单中额外记录源文件sha1（更慢，但不依赖mtime）")
     args = parser.parse_args()
 
     # 验证参数
@@ -107,6 +157,9 @@ def main():
     if args.width is not None and (args.width <= 0 or args.height <= 0):
         print("错误：宽度和高度必须为正整数")
         return
+    if args.workers <= 0:
+        print("错误：--workers必须为正整数")
+        return
 
     # 读取并排序帧文件
     frames = get_sorted_frames(args.input)
@@ -129,7 +182,17 @@ def main():
     # 创建输出目录
     os.makedirs(args.output, exist_ok=True)
 
-    # 处理每个部分
+    # 输出目录下的处理清单：来源与参数未变且输出完好的帧直接跳过
+    manifest = FrameManifest(
+        os.path.join(args.output, ".split_frames_manifest.json"),
+        params={"K": args.K, "m": args.m, "width": args.width, "height": args.height,
+                "draft": not args.no_draft, "quality": 95},
+        use_hash=args.hash,
+    )
+
+    # 处理每个部分：先规划所有帧，再统一（可并行）缩放保存
+    jobs = []
+    skipped = 0
     for part_idx, (start, end) in enumerate(parts):
         # 当前部分的帧（全局索引[start, end)）
         part_frames = frames[start:end]
@@ -152,9 +215,23 @@ def main():
             orig_path = os.path.join(args.input, orig_filename)
             new_filename = f"{new_idx:05d}.jpg"
             new_path = os.path.join(part_dir, new_filename)
-            
-            if resize_and_save(orig_path, new_path, args.width, args.height):
-                print(f"  处理完成：{orig_filename} -> {new_filename} {resize_info}")
+            if not args.force and manifest.is_fresh(orig_path, new_path):
+                skipped += 1
+                continue
+            jobs.append((orig_path, new_path, args.width, args.height, not args.no_draft))
+
+    if skipped:
+        print(f"\n清单显示{skipped}帧已是最新，跳过")
+    print(f"\n开始处理{len(jobs)}帧{resize_info}，进程数：{args.workers}")
+
+    def record(job, ok):
+        if ok:
+            manifest.record(job[0], job[1])
+
+    # 清单按批自动落盘，中断后重跑只处理未记录的帧
+    with manifest:
+        succeeded = run_jobs(jobs, workers=args.workers, chunksize=args.chunksize, on_result=record)
+    print(f"处理完成：成功{succeeded}帧，失败{len(jobs) - succeeded}帧")
 
     print("\n所有部分处理完成")
 
@@ -2,6 +2,253 @@ import cv2
 import numpy as np
 import os
 import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+
+def _plan_segments(
+    total_frames: int,
+    num_segments: int,
+    target_frames: int,
+    trim_head_ratio: float,
+    trim_tail_ratio: float,
+):
+    """Compute the sampled frame indices of every segment.
+
+    Returns:
+        list of (seg_idx, frame_indices) for segments that survive trimming.
+    """
+    frames_per_segment = total_frames // num_segments
+    if frames_per_segment <= 0:
+        raise ValueError("Too many segments for this video length")
+
+    plans = []
+    for seg_idx in range(num_segments):
+        start = seg_idx * frames_per_segment
+        end = start + frames_per_segment
+        if seg_idx == num_segments - 1:
+            end = total_frames  # include remaining frames
+
+        # Trim head/tail ratios
+        segment_length = end - start
+        head_trim = int(segment_length * trim_head_ratio)
+        tail_trim = int(segment_length * trim_tail_ratio)
+        start += head_trim
+        end -= tail_trim
+
+        if start >= end:
+            print(f"⚠️ Segment {seg_idx} skipped due to trimming too much.")
+            continue
+
+        # Sample frames uniformly
+        segment_total = end - start
+        if target_frames > segment_total:
+            raise ValueError(f"target_frames ({target_frames}) exceeds frames in segment {seg_idx} ({segment_total})")
+
+        plans.append((seg_idx, np.linspace(start, end - 1, target_frames, dtype=int)))
+
+    return plans
+
+
+def _annotate_frame(frame, index: int, target_width: int, target_height: int):
+    """Resize a frame and draw its 1-based index in the top-right corner."""
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    font_scale = 1.0
+    thickness_text = 3
+    thickness_border = 5
+
+    frame = cv2.resize(frame, (target_width, target_height))
+    text = f"Frame: {index + 1}"
+    (tw, th), _ = cv2.getTextSize(text, font, 1.0, 3)
+    x, y = target_width - tw - 10, th + 10
+    cv2.putText(frame, text, (x, y), font, font_scale, (0, 0, 0), thickness_border, cv2.LINE_AA)
+    cv2.putText(frame, text, (x, y), font, font_scale, (0, 0, 255), thickness_text, cv2.LINE_AA)
+    return frame
+
+
+class _SegmentWriter:
+    """Write BGR frames either into an ffmpeg H.264 stdin pipe or an OpenCV mp4v writer."""
+
+    def __init__(self, dst_path: str, width: int, height: int, fps: float, h264: bool):
+        self.dst_path = dst_path
+        self.proc = None
+        self.writer = None
+        self.closed = False
+        if h264:
+            self.cmd = [
+                "ffmpeg", "-y",
+                "-f", "rawvideo",
+                "-pix_fmt", "bgr24",
+                "-s", f"{width}x{height}",
+                "-r", str(fps),
+                "-i", "-",
+                "-c:v", "libx264",
+                "-pix_fmt", "yuv420p",
+                dst_path
+            ]
+            # stderr goes to a temp file so a failed encode can report why
+            self.stderr = tempfile.TemporaryFile()
+            try:
+                self.proc = subprocess.Popen(
+                    self.cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=self.stderr
+                )
+                return
+            except FileNotFoundError as e:
+                self.stderr.close()
+                print(f"⚠️ FFmpeg not available, falling back to mp4v: {e}")
+
+        self.writer = cv2.VideoWriter(dst_path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+        if not self.writer.isOpened():
+            raise ValueError(f"Failed to initialize VideoWriter for {dst_path}")
+
+    def write(self, frame):
+        if self.proc is not None:
+            try:
+                self.proc.stdin.write(np.ascontiguousarray(frame).tobytes())
+            except BrokenPipeError:
+                # ffmpeg exited early; surface its exit code and stderr
+                self.close()
+                raise subprocess.CalledProcessError(
+                    self.proc.returncode, self.cmd, stderr=self.stderr_text
+                )
+        else:
+            self.writer.write(frame)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.proc is not None:
+            try:
+                self.proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            returncode = self.proc.wait()
+            self.stderr.seek(0)
+            self.stderr_text = self.stderr.read().decode(errors="replace")[-4096:]
+            self.stderr.close()
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, self.cmd, stderr=self.stderr_text)
+        else:
+            self.writer.release()
+
+
+def _iter_sampled_frames(cap, frame_indices, position: int = 0):
+    """Yield (frame_idx, ok, frame, position) for sorted frame_indices.
+
+    Decoding runs forward from ``position`` (the index of the next frame the
+    decoder returns); frames in between are skipped with ``cap.grab()``.
+    """
+    for frame_idx in frame_indices:
+        while position < frame_idx and cap.grab():
+            position += 1
+        ret, frame = False, None
+        if position == frame_idx:
+            ret, frame = cap.read()
+            if ret:
+                position += 1
+        yield frame_idx, ret, frame, position
+
+
+def _encode_segment(
+    src_path: str,
+    dst_dir: str,
+    seg_idx: int,
+    frame_indices,
+    target_width: int,
+    target_height: int,
+    target_fps: float,
+    reencode_h264: bool,
+):
+    """Decode and encode one segment in its own process: one seek, then forward decode.
+
+    Returns:
+        (seg_idx, dst_path, decoded_frames)
+    """
+    cap = cv2.VideoCapture(src_path)
+    if not cap.isOpened():
+        raise ValueError(f"Failed to open video: {src_path}")
+
+    frame_indices = [int(idx) for idx in frame_indices]
+    first = frame_indices[0]
+    if first > 0:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, first)
+
+    dst_path = os.path.join(dst_dir, f"output_{seg_idx}.mp4")
+    writer = _SegmentWriter(dst_path, target_width, target_height, target_fps, reencode_h264)
+    position = first
+    try:
+        for i, (frame_idx, ret, frame, position) in enumerate(
+            _iter_sampled_frames(cap, frame_indices, first)
+        ):
+            if not ret:
+                print(f"⚠️ Failed to read frame {frame_idx}, skipped.")
+                continue
+            writer.write(_annotate_frame(frame, i, target_width, target_height))
+    finally:
+        writer.close()
+        cap.release()
+
+    print(f"✅ Segment {seg_idx} saved to {dst_path}")
+    return seg_idx, dst_path, position - first
+
+
+def _encode_all_single_pass(
+    src_path: str,
+    dst_dir: str,
+    plans,
+    target_width: int,
+    target_height: int,
+    target_fps: float,
+    reencode_h264: bool,
+) -> int:
+    """Write every segment from one forward decode pass; returns decoded frame count."""
+    cap = cv2.VideoCapture(src_path)
+    if not cap.isOpened():
+        raise ValueError(f"Failed to open video: {src_path}")
+
+    # frame index -> [(seg_idx, position in segment)]
+    wanted = {}
+    for seg_idx, frame_indices in plans:
+        for i, frame_idx in enumerate(frame_indices):
+            wanted.setdefault(int(frame_idx), []).append((seg_idx, i))
+    remaining = {seg_idx: len(frame_indices) for seg_idx, frame_indices in plans}
+
+    writers = {}
+
+    def finish_segment(seg_idx):
+        writer = writers.pop(seg_idx)
+        writer.close()
+        print(f"✅ Segment {seg_idx} saved to {writer.dst_path}")
+
+    position = 0
+    try:
+        for frame_idx, ret, frame, position in _iter_sampled_frames(cap, sorted(wanted)):
+            for seg_idx, i in wanted[frame_idx]:
+                if seg_idx not in writers:
+                    dst_path = os.path.join(dst_dir, f"output_{seg_idx}.mp4")
+                    writers[seg_idx] = _SegmentWriter(
+                        dst_path, target_width, target_height, target_fps, reencode_h264
+                    )
+
+                if ret:
+                    writers[seg_idx].write(
+                        _annotate_frame(frame, i, target_width, target_height)
+                    )
+                else:
+                    print(f"⚠️ Failed to read frame {frame_idx}, skipped.")
+
+                remaining[seg_idx] -= 1
+                if remaining[seg_idx] == 0:
+                    finish_segment(seg_idx)
+    finally:
+        for seg_idx in list(writers):
+            finish_segment(seg_idx)
+        cap.release()
+
+    return position
+
 
 def process_video_segments(
     src_path: str,
@@ -14,11 +261,22 @@ def process_video_segments(
     trim_head_ratio: float = 0.0,
     trim_tail_ratio: float = 0.0,
     reencode_h264: bool = True,
+    num_workers: int = 1,
 ):
     """
-    Process a video by splitting it into segments, trimming and sampling frames, 
+    Process a video by splitting it into segments, trimming and sampling frames,
     and writing each segment to a separate video file with frame annotations.
 
+    Sampled frames are decoded forward, skipping frames in between with
+    ``cap.grab()`` instead of seeking before every frame. With
+    ``num_workers == 1`` all segments are written from a single decode pass;
+    otherwise segments are decoded and encoded concurrently in a process pool,
+    each worker seeking once to its segment start.
+
+    With ``reencode_h264`` raw BGR frames are piped straight into an
+    ``ffmpeg -f rawvideo`` H.264 encoder (no intermediate mp4v file);
+    otherwise OpenCV writes mp4v directly.
+
     Args:
         src_path (str): Path to input video.
         dst_dir (str): Directory to save output videos.
@@ -29,15 +287,13 @@ def process_video_segments(
         num_segments (int): Number of segments (K).
         trim_head_ratio (float): Ratio (0-1) of frames to trim from start of each segment.
         trim_tail_ratio (float): Ratio (0-1) of frames to trim from end of each segment.
-        reencode_h264 (bool): Whether to reencode to H.264 (requires ffmpeg).
+        reencode_h264 (bool): Whether to encode H.264 (requires ffmpeg).
+        num_workers (int): Number of processes encoding segments concurrently.
 
     Raises:
         ValueError: If invalid parameters or OpenCV fails to read/write.
+        subprocess.CalledProcessError: If the ffmpeg H.264 encoder fails (stderr attached).
     """
-    font_scale = 1.0
-    thickness_text = 3
-    thickness_border = 5
-
     # ---- Check input validity ----
     if not os.path.exists(src_path):
         raise ValueError(f"Source video not found: {src_path}")
@@ -47,92 +303,52 @@ def process_video_segments(
         raise ValueError("trim_head_ratio and trim_tail_ratio must be between 0 and 1")
     if trim_head_ratio + trim_tail_ratio >= 1.0:
         raise ValueError("Sum of trim_head_ratio and trim_tail_ratio must be < 1.0")
+    if num_workers < 1:
+        raise ValueError("num_workers must be >= 1")
 
     os.makedirs(dst_dir, exist_ok=True)
 
     cap = cv2.VideoCapture(src_path)
     if not cap.isOpened():
         raise ValueError(f"Failed to open video: {src_path}")
-
     total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
     if total_frames <= 0:
         raise ValueError("Source video has no frames")
 
-    # Split frame ranges for each segment
-    frames_per_segment = total_frames // num_segments
-    if frames_per_segment <= 0:
-        raise ValueError("Too many segments for this video length")
-
-    font = cv2.FONT_HERSHEY_SIMPLEX
-    fourcc = cv2.VideoWriter_fourcc(*"mp4v")
-
-    # ---- Process each segment ----
-    for seg_idx in range(num_segments):
-        start = seg_idx * frames_per_segment
-        end = start + frames_per_segment
-        if seg_idx == num_segments - 1:
-            end = total_frames  # include remaining frames
-
-        # Trim head/tail ratios
-        segment_length = end - start
-        head_trim = int(segment_length * trim_head_ratio)
-        tail_trim = int(segment_length * trim_tail_ratio)
-        start += head_trim
-        end -= tail_trim
-
-        if start >= end:
-            print(f"⚠️ Segment {seg_idx} skipped due to trimming too much.")
-            continue
-
-        # Sample frames uniformly
-        segment_total = end - start
-        if target_frames > segment_total:
-            raise ValueError(f"target_frames ({target_frames}) exceeds frames in segment {seg_idx} ({segment_total})")
-
-        frame_indices = np.linspace(start, end - 1, target_frames, dtype=int)
-
-        temp_path = os.path.join(dst_dir, f"temp_seg_{seg_idx}.mp4")
-        dst_path = os.path.join(dst_dir, f"output_{seg_idx}.mp4")
-
-        out = cv2.VideoWriter(temp_path, fourcc, target_fps, (target_width, target_height))
-        if not out.isOpened():
-            raise ValueError(f"Failed to initialize VideoWriter for segment {seg_idx}")
-
-        for i, frame_idx in enumerate(frame_indices):
-            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
-            ret, frame = cap.read()
-            if not ret:
-                print(f"⚠️ Failed to read frame {frame_idx}, skipped.")
-                continue
-
-            frame = cv2.resize(frame, (target_width, target_height))
-            text = f"Frame: {i+1}"
-            (tw, th), _ = cv2.getTextSize(text, font, 1.0, 3)
-            x, y = target_width - tw - 10, th + 10
-            cv2.putText(frame, text, (x, y), font, font_scale, (0, 0, 0), thickness_border, cv2.LINE_AA)
-            cv2.putText(frame, text, (x, y), font, font_scale, (0, 0, 255), thickness_text, cv2.LINE_AA)
-            out.write(frame)
-
-        out.release()
+    plans = _plan_segments(
+        total_frames, num_segments, target_frames, trim_head_ratio, trim_tail_ratio
+    )
 
-        # Optional re-encode to H.264
-        if reencode_h264:
-            try:
-                subprocess.run([
-                    "ffmpeg", "-y",
-                    "-i", temp_path,
-                    "-c:v", "libx264",
-                    "-pix_fmt", "yuv420p",
-                    dst_path
-                ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                os.remove(temp_path)
-            except Exception as e:
-                print(f"⚠️ FFmpeg re-encode failed for segment {seg_idx}: {e}")
-                os.rename(temp_path, dst_path)
-
-        print(f"✅ Segment {seg_idx} saved to {dst_path}")
+    start_time = time.perf_counter()
+    if num_workers == 1 or len(plans) <= 1:
+        decoded = _encode_all_single_pass(
+            src_path, dst_dir, plans, target_width, target_height, target_fps, reencode_h264
+        )
+    else:
+        decoded = 0
+        with ProcessPoolExecutor(max_workers=min(num_workers, len(plans))) as pool:
+            futures = [
+                pool.submit(
+                    _encode_segment,
+                    src_path,
+                    dst_dir,
+                    seg_idx,
+                    frame_indices,
+                    target_width,
+                    target_height,
+                    target_fps,
+                    reencode_h264,
+                )
+                for seg_idx, frame_indices in plans
+            ]
+            for future in futures:
+                decoded += future.result()[2]
 
-    cap.release()
+    elapsed = time.perf_counter() - start_time
+    decode_fps = decoded / elapsed if elapsed > 0 else 0.0
+    sampled = sum(len(frame_indices) for _, frame_indices in plans)
+    print(f"📈 Decoded {decoded} frames ({sampled} sampled) in {elapsed:.2f}s, {decode_fps:.1f} frames/sec")
     print("🎬 All segments processed successfully.")
 
 
@@ -147,5 +363,6 @@ if __name__ == '__main__':
         num_segments=4,
         trim_head_ratio=0.05,
         trim_tail_ratio=0.05,
-        reencode_h264=True
+        reencode_h264=True,
+        num_workers=4
     )
@@ -15,9 +15,9 @@ apiClient.interceptors.request.use(config => config, error => Promise.reject(err
 apiClient.interceptors.response.use(response => response.data, error => Promise.reject(error))
 
 export const api = {
-  // 扫描文件夹
-  scanFolder: async (folderPath) => {
-    return await apiClient.post('/scan_folder', { folder_path: folderPath })
+  // 扫描文件夹；可选分页 { offset, limit }，limit 为 0 时只返回帧总数
+  scanFolder: async (folderPath, { offset = 0, limit = null } = {}) => {
+    return await apiClient.post('/scan_folder', { folder_path: folderPath, offset, limit })
   },
 
   // 获取单帧图像 URL
@@ -26,8 +26,36 @@ export const api = {
     // 前端 /api 会代理到 FastAPI 服务
     return `${API_BASE}/frame_image?folder_path=${encodeURIComponent(folderPath)}&filename=${encodeURIComponent(filename)}`
   },
+
+  // 获取帧缩略图 URL（服务端磁盘缓存，支持 ETag 协商缓存）
+  getFrameThumbUrl: (folderPath, filename, { maxSide = 320, quality = 80 } = {}) => {
+    return `${API_BASE}/frame_thumb?folder_path=${encodeURIComponent(folderPath)}&filename=${encodeURIComponent(filename)}&max_side=${maxSide}&quality=${quality}`
+  },
   // 其他接口
   segmentFrame: async (data) => await apiClient.post('/segment_frame', data),
   segmentFrames: async (data) => await apiClient.post('/segment_frames', data),
-  getTaskStatus: async (taskId) => await apiClient.get(`/task_status/${taskId}`)
+  propagate: async (data) => await apiClient.post('/propagate', data),
+  getTaskStatus: async (taskId) => await apiClient.get(`/task_status/${taskId}`),
+
+  // 订阅任务事件（SSE），返回 EventSource，调用方负责 close()
+  // handlers: { onStatus, onFrame, onDone, onError }
+  subscribeTaskEvents: (taskId, handlers = {}) => {
+    const source = new EventSource(`${API_BASE}/task_events/${taskId}`)
+    const parse = (e) => JSON.parse(e.data)
+
+    source.addEventListener('queued', e => handlers.onStatus?.(parse(e)))
+    source.addEventListener('processing', e => handlers.onStatus?.(parse(e)))
+    source.addEventListener('frame', e => handlers.onFrame?.(parse(e)))
+    source.addEventListener('done', e => {
+      source.close()
+      handlers.onDone?.(parse(e))
+    })
+    source.addEventListener('error', e => {
+      source.close()
+      // 服务端推送的 error 事件带 data；连接异常时没有
+      handlers.onError?.(e.data ? parse(e) : { result: '事件连接中断' })
+    })
+
+    return source
+  }
 }